@@ -5,6 +5,8 @@ from flask import Flask
 from flask_cors import CORS
 from flask_restx import Api
 
+from .clients import neo4j
+
 # Flask configuration
 app = Flask(__name__)
 app.debug = False if os.environ["DAISY_PRODUCTION"] == "true" else True
@@ -40,3 +42,6 @@ celery = Celery(app.name, broker_url=f"amqp://{os.environ['RABBITMQ_DEFAULT_USER
 celery.set_default()
 
 CORS(app)
+
+# Closes the Neo4j read session that is reused for the whole request
+app.teardown_appcontext(neo4j.close_read_session)
@@ -5,6 +5,7 @@ import logging
 
 from celery import chord, group
 from celery.result import result_from_tuple
+from celery.utils import uuid
 from flask import Response
 from flask import request
 from flask_restx import Resource, fields
@@ -12,9 +13,9 @@ from flask_restx import Resource, fields
 from backend import api
 # Import own modules
 from backend import app
-from backend.discovery.queries import delete_spurious_connections, get_related_between_two_tables
+from backend.discovery.queries import delete_spurious_connections, get_related_to_targets
 from backend.utility.celery_tasks import *
-from backend.utility.celery_utils import generate_status_tree
+from backend.utility.celery_utils import claim_tables, generate_status_tree
 from backend.utility.display import log_format
 from backend.search import redis_tools as db
 
@@ -23,9 +24,16 @@ logging.basicConfig(format=log_format, level=logging.INFO)
 
 TaskIdModel = api.model('TaskId', {'task_id': fields.String, 'type': fields.String})
 
+# Number of joinable tables per page when a cursor is given without a limit
+DEFAULT_PAGE_SIZE = 50
+
 
 @api.route('/ingest-data')
 @api.doc(description="Ingest all the data present in the data volume.")
+@api.doc(params={
+    'force': {'description': 'Also ingest the tables that did not change since they were ingested', 'in': 'query',
+              'type': 'boolean', 'required': 'false'}
+})
 class IngestData(Resource):
     @api.response(202, 'Success, processing in backend', TaskIdModel)
     @api.response(204, 'No data on volume')
@@ -34,15 +42,14 @@ class IngestData(Resource):
         if len(paths) == 0:
             return Response("No data present on volume", status=204)
 
-        header = []
-        for table_path in paths:
-            if not db.table_exists(table_path):
-                header.append(add_table.s(table_path))
-            else:
-                logging.info(f"Table {table_path} was already processed!")
+        run_id = uuid()
+        force = request.args.get('force', 'false').lower() == 'true'
+        claimed, in_flight = claim_tables(paths, run_id, force=force)
+        for table_path, owner in in_flight.items():
+            logging.info(f"Table {table_path} is already being ingested by run {owner}, skipping")
 
-        task_group = group(*header)
-        profiling_chord = chord(task_group)(profile_valentine_all.si() | find_inds_all.si())
+        task_group = group(*[add_table.si(table_path, run_id) for table_path in claimed])
+        profiling_chord = chord(task_group)(profile_valentine_all.si() | find_inds_all.si(), task_id=run_id)
         profiling_chord.parent.save()
         db.save_celery_task(profiling_chord.id, profiling_chord.as_tuple())
 
@@ -96,18 +103,30 @@ class Purge(Resource):
     @api.response(200, 'Success')
     def get(self):
         db.purge()
+        search.df_cache.get_cache().clear(disk=True)
         discovery.crud.delete_all_nodes()
         return Response('Success', status=200)
 
 
 @api.route('/filter-connections')
 @api.doc(description="Filters spurious connections. This step is required after the ingestion phase.")
+@api.doc(params={
+    'async': {'description': 'Filter in the backend and return the id of the task, for large graphs', 'in': 'query',
+              'type': 'boolean', 'required': 'false'}
+})
 class FilterConnections(Resource):
     # NOTE: We can only have a single response per code, see: https://github.com/python-restx/flask-restx/issues/274
     @api.response(200, 'Success', api.model('DeletedRelations', {
         'deleted_relations': fields.List(fields.String)
     }))
+    @api.response(202, 'Success, processing in backend', TaskIdModel)
     def get(self):
+        if request.args.get('async', 'false').lower() == 'true':
+            task = filter_connections.delay()
+            db.save_celery_task(task.id, task.as_tuple())
+            return Response(json.dumps({"task_id": task.id, "type": "Filter Connections"}),
+                            mimetype='application/json', status=202)
+
         deleted_relations = delete_spurious_connections()
 
         if not deleted_relations:
@@ -150,11 +169,14 @@ class ProfileValentine(Resource):
 @api.route('/add-table')
 @api.doc(description="Initiates ingestion and profiling for the table in the given asset.")
 @api.doc(params={
-    'asset_id': {'description': 'The id of the asset to get the table from', 'in': 'query', 'type': 'string', 'required': 'true'}
+    'asset_id': {'description': 'The id of the asset to get the table from', 'in': 'query', 'type': 'string', 'required': 'true'},
+    'force': {'description': 'Also ingest the table if it did not change since it was ingested', 'in': 'query',
+              'type': 'boolean', 'required': 'false'}
 })
 class AddTable(Resource):
     @api.response(400, 'Missing asset id query parameter')
-    @api.response(204, 'Table in asset was already processed')
+    @api.response(202, 'Success, processing in backend or attached to the ingestion already in progress', TaskIdModel)
+    @api.response(204, 'Table in asset was already processed and did not change')
     @api.response(404, 'Table or asset does not exist')
     def get(self):
         asset_id = request.args.get('asset_id')
@@ -166,10 +188,18 @@ class AddTable(Resource):
         if not table_path:
             return Response("Table or asset does not exist", status=404)
 
-        if db.get_table(table_path):
-            return Response("Table in asset was already processed", status=204)
-
-        task = (add_table.si(table_path) | profile_valentine_star.si(table_path)).apply_async()
+        run_id = uuid()
+        force = request.args.get('force', 'false').lower() == 'true'
+        claimed, in_flight = claim_tables([table_path], run_id, force=force)
+        if in_flight.get(table_path):
+            return Response(json.dumps({"task_id": in_flight[table_path], "type": "Single Ingestion"}),
+                            mimetype='application/json', status=202)
+        if not claimed:
+            return Response("Table in asset was already processed and did not change", status=204)
+
+        # Re-ingesting a table replaces its relations, so both its matches and its INDs are found again
+        task = (add_table.si(table_path, run_id) | profile_valentine_star.si(table_path) | find_inds_star.si(table_path)) \
+            .apply_async(task_id=run_id)
         db.save_celery_task(task.id, task.as_tuple())
 
         return Response(json.dumps({"task_id": task.id, "type": "Single Ingestion"}), mimetype='application/json',
@@ -212,7 +242,9 @@ RelatedTableModel = api.model("RelatedTable", {
 })
 class GetRelatedNodes(Resource):
     @api.response(200, 'Success',
-                  api.model("RelatedTables", {"RelatedTables": fields.List(fields.Nested(RelatedTableModel))}))
+                  api.model("RelatedTables", {
+                      "RelatedTables": fields.List(fields.Nested(RelatedTableModel)),
+                      "RelatedTablesPerTarget": fields.Raw(description="The related tables per target asset id")}))
     @api.response(400, 'Missing asset ids query parameters')
     @api.response(403, 'Source asset id is among target asset ids')
     @api.response(404, 'Table in asset does not exist')
@@ -233,31 +265,37 @@ class GetRelatedNodes(Resource):
         if source_asset_id in target_asset_ids:
             return Response("Source asset id should not be in target asset ids", status=403)
 
-        source_nodes = discovery.node_helper.get_nodes_path_contains(source_asset_id)
+        source_nodes = discovery.node_helper.get_table_paths_by_asset_id(source_asset_id)
         if len(source_nodes) == 0:
             return Response("Table or asset does not exist", status=404)
 
+        # Resolve the tables of all targets at once, so that every source is searched from only once
+        target_nodes = discovery.node_helper.get_table_paths_by_asset_ids(target_asset_ids)
+        target_tables = {}
+        for asset_id in target_asset_ids:
+            if not target_nodes.get(asset_id):
+                logging.warning(f"Given asset '{asset_id}' does not exist")
+            tables = map(search.redis_tools.get_table, target_nodes.get(asset_id, []))
+            target_tables[asset_id] = [table for table in tables if table is not None]
+        to_tables = [to_table for tables in target_tables.values() for to_table in tables]
+
         related_tables = []
+        related_per_target = {asset_id: [] for asset_id in target_asset_ids}
 
         for source in source_nodes:
-            print(f"From asset id: {source}")
+            logging.info(f"From asset id: {source}")
             from_table = search.redis_tools.get_table(source)
+            if from_table is None:
+                continue
 
-            for asset_id in target_asset_ids:
-                logging.info(f"Processing {asset_id}")
-                target_nodes = discovery.node_helper.get_nodes_path_contains(asset_id)
-
-                if len(target_nodes) == 0:
-                    logging.warning(f"Given asset '{asset_id}' does not exist")
-                    continue
-
-                for target in target_nodes:
-                    to_table = search.redis_tools.get_table(target)
-                    if to_table is None:
-                        continue
-                    related_tables += get_related_between_two_tables(from_table, to_table)
+            related = get_related_to_targets(from_table, to_tables)
+            for asset_id, tables in target_tables.items():
+                for to_table in tables:
+                    related_tables += related[to_table['path']]
+                    related_per_target[asset_id] += related[to_table['path']]
 
-        return Response(json.dumps({"RelatedTables": related_tables}), mimetype='application/json', status=200)
+        return Response(json.dumps({"RelatedTables": related_tables, "RelatedTablesPerTarget": related_per_target}),
+                        mimetype='application/json', status=200)
 
 
 # Apparently we need to make models for every nested field...
@@ -274,14 +312,20 @@ JoinableTableModel = api.model("JoinableTable", {
 
 
 @api.route('/get-joinable')
-@api.doc(description="Gets all assets that are joinable with the given source asset.")
+@api.doc(description="Gets all assets that are joinable with the given source asset, ranked by the number of "
+                     "joinable columns and their mean score. Give a limit to get the results page by page.")
 @api.doc(params={
-    'asset_id': {'description': 'The id of the asset to get the table from', 'in': 'query', 'type': 'string', 'required': 'true'}
+    'asset_id': {'description': 'The id of the asset to get the table from', 'in': 'query', 'type': 'string', 'required': 'true'},
+    'limit': {'description': 'Maximum number of joinable tables to return', 'in': 'query', 'type': 'integer', 'required': 'false'},
+    'cursor': {'description': 'The next_cursor of the previous page, to continue after it', 'in': 'query', 'type': 'string', 'required': 'false'},
+    'stream': {'description': 'Stream the joinable tables as newline-delimited JSON, ending with the next_cursor '
+                              'if a limit is given', 'in': 'query', 'type': 'boolean', 'required': 'false'}
 })
 class GetJoinable(Resource):
     @api.response(200, 'Success', api.model("JoinableTables", {
-        "JoinableTables": fields.List(fields.Nested(JoinableTableModel))}))  # TODO: specify return model
-    @api.response(400, 'Missing asset id query parameter')
+        "JoinableTables": fields.List(fields.Nested(JoinableTableModel)),
+        "next_cursor": fields.String}))  # TODO: specify return model
+    @api.response(400, 'Missing asset id query parameter, or invalid limit or cursor')
     @api.response(404, 'Table or table does not exist')
     def get(self):
         args = request.args
@@ -289,10 +333,29 @@ class GetJoinable(Resource):
         if asset_id is None:
             return Response("Please provide an asset id as query parameter", status=400)
 
-        nodes = discovery.node_helper.get_nodes_path_contains(asset_id)
+        limit = args.get("limit", type=int)
+        cursor = args.get("cursor")
+        stream = args.get("stream", "false").lower() == "true"
+        if "limit" in args and (limit is None or limit < 1):
+            return Response("The limit should be a positive integer", status=400)
+        try:
+            discovery.queries.decode_cursor(cursor)
+        except ValueError as e:
+            return Response(str(e), status=400)
+
+        nodes = discovery.node_helper.get_table_paths_by_asset_id(asset_id)
         if len(nodes) == 0:
             return Response("Table or asset does not exist", status=404)
 
+        if stream:
+            return Response(_stream_joinable(nodes, limit, cursor), mimetype='application/x-ndjson', status=200)
+
+        if limit is not None or cursor:
+            joinable_tables, next_cursor = discovery.queries.get_joinable_page(nodes, limit or DEFAULT_PAGE_SIZE,
+                                                                               cursor)
+            return Response(json.dumps({"JoinableTables": joinable_tables, "next_cursor": next_cursor}),
+                            mimetype='application/json', status=200)
+
         joinable_tables = []
         for node in nodes:
             logging.info(f"Asset id: {node}")
@@ -305,6 +368,16 @@ class GetJoinable(Resource):
                         mimetype='application/json', status=200)
 
 
+def _stream_joinable(table_paths, limit, cursor):
+    count = 0
+    next_cursor = None
+    for joinable_table, next_cursor in discovery.queries.iter_joinable(table_paths, limit, cursor):
+        count += 1
+        yield json.dumps(joinable_table) + "\n"
+    if limit is not None:
+        yield json.dumps({"next_cursor": next_cursor if count == limit else None}) + "\n"
+
+
 DEFAULT_PORT = 8080
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+"""
+Compares the CSV parse throughput of the sniffing python engine with the C engine using a stored dialect and dtypes.
+
+Run inside the backend container with: python -m backend.benchmarks.csv_parsing [table_path ...]
+Without table paths, all tables on the data volume are used.
+"""
+import sys
+import time
+
+from typing import Callable, List
+
+import pandas as pd
+
+from backend.search import io_tools
+
+
+def _time(parse: Callable[[], pd.DataFrame], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(table_paths: List[str], repeat: int = 3) -> None:
+    total_bytes = 0
+    total_before = 0.0
+    total_after = 0.0
+
+    print(f"{'table':<60} {'MB':>8} {'before MB/s':>12} {'after MB/s':>12} {'speedup':>8}")
+    for table_path in table_paths:
+        path = io_tools.root_path() / table_path
+        size = path.stat().st_size / 1e6
+
+        # Dialect detection and dtype inference happen once during ingestion, so they are not timed
+        dialect = io_tools.sniff_dialect(table_path)
+        dtypes = io_tools.get_dtypes(io_tools._read_csv(table_path, dialect=dialect))
+
+        before = _time(lambda: io_tools.read_csv_sniffing(path), repeat)
+        after = _time(lambda: io_tools._read_csv(table_path, dialect=dialect, dtypes=dtypes), repeat)
+
+        total_bytes += size
+        total_before += before
+        total_after += after
+        print(f"{table_path[-60:]:<60} {size:>8.2f} {size / before:>12.2f} {size / after:>12.2f} {before / after:>7.1f}x")
+
+    if table_paths:
+        print(f"{'total':<60} {total_bytes:>8.2f} {total_bytes / total_before:>12.2f} "
+              f"{total_bytes / total_after:>12.2f} {total_before / total_after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:] or io_tools.get_tables())
@@ -1,9 +1,31 @@
 import os
+import logging
+from contextlib import contextmanager
 
-from neo4j import GraphDatabase, Neo4jDriver
+from flask import g, has_app_context
+from neo4j import GraphDatabase, Neo4jDriver, READ_ACCESS
+from neo4j.exceptions import ClientError
 
 neo4j_client: Neo4jDriver = None
 
+# Connection pool of the driver, the timeouts are in seconds
+MAX_POOL_SIZE = int(os.environ.get("NEO4J_MAX_POOL_SIZE", 100))
+CONNECTION_TIMEOUT = float(os.environ.get("NEO4J_CONNECTION_TIMEOUT", 30))
+ACQUISITION_TIMEOUT = float(os.environ.get("NEO4J_ACQUISITION_TIMEOUT", 60))
+MAX_CONNECTION_LIFETIME = float(os.environ.get("NEO4J_MAX_CONNECTION_LIFETIME", 3600))
+MAX_RETRY_TIME = float(os.environ.get("NEO4J_MAX_RETRY_TIME", 30))
+
+# Idempotent schema statements, executed once when the client is created, each with the index that is created instead
+# when it cannot be applied, e.g. when a uniqueness constraint fails because of already existing duplicate nodes
+SCHEMA_STATEMENTS = [
+    ("CREATE CONSTRAINT node_id IF NOT EXISTS FOR (n:Node) REQUIRE n.id IS UNIQUE",
+     "CREATE INDEX node_id_index IF NOT EXISTS FOR (n:Node) ON (n.id)"),
+    ("CREATE INDEX node_source_path IF NOT EXISTS FOR (n:Node) ON (n.source_path)", None),
+    ("CREATE INDEX node_asset_id IF NOT EXISTS FOR (n:Node) ON (n.asset_id)", None),
+    ("CREATE CONSTRAINT table_path IF NOT EXISTS FOR (t:Table) REQUIRE t.path IS UNIQUE",
+     "CREATE INDEX table_path_index IF NOT EXISTS FOR (t:Table) ON (t.path)"),
+]
+
 
 def get_client() -> Neo4jDriver:
     global neo4j_client
@@ -12,6 +34,45 @@ def get_client() -> Neo4jDriver:
         address = os.environ["NEO4J_ADDRESS"]
         neo4j_client = GraphDatabase.driver(
             f"neo4j://{address}",
-            auth=tuple(os.environ["NEO4J_AUTH"].split("/"))
+            auth=tuple(os.environ["NEO4J_AUTH"].split("/")),
+            max_connection_pool_size=MAX_POOL_SIZE,
+            connection_timeout=CONNECTION_TIMEOUT,
+            connection_acquisition_timeout=ACQUISITION_TIMEOUT,
+            max_connection_lifetime=MAX_CONNECTION_LIFETIME,
+            max_transaction_retry_time=MAX_RETRY_TIME
         )
+        initialize()
     return neo4j_client
+
+
+@contextmanager
+def read_session():
+    """
+    Gets a session for read transactions, which the routing driver spreads over the read replicas of the cluster.
+    While handling a request, the same session is reused for the whole request and closed once it is torn down.
+    """
+    if not has_app_context():
+        with get_client().session(default_access_mode=READ_ACCESS) as session:
+            yield session
+        return
+    if "neo4j_read_session" not in g:
+        g.neo4j_read_session = get_client().session(default_access_mode=READ_ACCESS)
+    yield g.neo4j_read_session
+
+
+def close_read_session(exception=None):
+    session = g.pop("neo4j_read_session", None)
+    if session is not None:
+        session.close()
+
+
+def initialize():
+    logging.info("Initializing Neo4j schema...")
+    with get_client().session() as session:
+        for statement, fallback in SCHEMA_STATEMENTS:
+            try:
+                session.run(statement).consume()
+            except ClientError as e:
+                logging.warning(f"Could not apply schema statement '{statement}' because: {e.message}")
+                if fallback is not None:
+                    session.run(fallback).consume()
@@ -1 +1 @@
-from . import crud, edge_helper, node_helper, queries, relation_types, utilities
+from . import crud, edge_helper, graph_snapshot, node_helper, queries, relation_sink, relation_types, table_graph, utilities
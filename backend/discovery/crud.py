@@ -6,6 +6,10 @@ def create_node(asset_id, table_name, table_path, column_name):
     return node_helper.create_node(asset_id, table_name, table_path, column_name)
 
 
+def create_nodes(asset_id, table_name, table_path, columns_with_props):
+    return node_helper.create_nodes(asset_id, table_name, table_path, columns_with_props)
+
+
 def get_nodes():
     return node_helper.get_all()
 
@@ -22,6 +26,22 @@ def delete_node_property(node_property, **kwargs):
     return node_helper.delete_property(node_property, **kwargs)
 
 
+def get_table_nodes(table_path):
+    return node_helper.get_nodes_by_table_path(table_path)
+
+
+def update_table_nodes(table_path, columns_with_props):
+    return node_helper.update_nodes(table_path, columns_with_props)
+
+
+def delete_table_relations(table_path):
+    return edge_helper.delete_table_relations(table_path)
+
+
+def delete_table_nodes(table_path):
+    return node_helper.delete_nodes_by_table_path(table_path)
+
+
 def delete_all_nodes():
     return node_helper.delete_all()
 
@@ -34,6 +54,10 @@ def create_relation(from_node_id, to_node_id, relation_name):
     return edge_helper.create_relation(from_node_id, to_node_id, relation_name)
 
 
+def create_relations(relation_name, rows):
+    return edge_helper.create_relations(relation_name, rows)
+
+
 def set_relation_properties(from_node_id, to_node_id, relation_name, **kwargs):
     return edge_helper.set_properties(from_node_id, to_node_id, relation_name, **kwargs)
 
@@ -1,18 +1,33 @@
+import os
+
 from . import relation_types
 from ..clients import neo4j as neo
+from ..search import redis_tools
+
+# Number of relations deleted per transaction when deleting relations in bulk
+DELETE_BATCH_SIZE = int(os.environ.get("RELATION_DELETE_BATCH_SIZE", 10000))
 
 
 def create_subsumption_relation(source):
     with neo.get_client().session() as session:
         relation = session.write_transaction(_create_subsumption_relation, source)
+    redis_tools.bump_graph_version([source])
 
 
 def create_relation(from_node_id, to_node_id, relation_name):
     with neo.get_client().session() as session:
         relation = session.write_transaction(_create_relation, from_node_id, to_node_id, relation_name)
+    redis_tools.bump_graph_version()
     return relation
 
 
+def create_relations(relation_name, rows):
+    with neo.get_client().session() as session:
+        count, table_paths = session.write_transaction(_create_relations, relation_name, rows)
+    redis_tools.bump_graph_version(table_paths)
+    return count
+
+
 def set_properties(from_node_id, to_node_id, relation_name, **kwargs):
     with neo.get_client().session() as session:
         relation = session.write_transaction(_set_properties, from_node_id, to_node_id, relation_name, **kwargs)
@@ -23,30 +38,79 @@ def delete_relation_between_nodes(from_node_id, to_node_id, relation_name):
     with neo.get_client().session() as session:
         relation = session.write_transaction(_delete_relation_between_nodes, from_node_id, to_node_id,
                                              relation_name)
+    redis_tools.bump_graph_version()
     return relation
 
 
 def delete_relations_by_name(relation_name):
     with neo.get_client().session() as session:
         relations = session.write_transaction(_delete_relations_by_name, relation_name)
+    redis_tools.bump_graph_version()
     return relations
 
 
-def get_related_relations():
+def delete_table_relations(table_path):
     with neo.get_client().session() as session:
-        relations = session.write_transaction(_get_related_relations)
-    return relations
+        count = session.write_transaction(_delete_table_relations, table_path)
+    # All deleted relations touch the columns of the table, so reloading its relations drops them
+    redis_tools.bump_graph_version([table_path])
+    return count
+
+
+def delete_unweighted_relations(batch_size=DELETE_BATCH_SIZE):
+    # CALL { } IN TRANSACTIONS commits its own batches, so it can only run in an auto-commit query
+    with neo.get_client().session() as session:
+        records = list(session.run(
+            f"MATCH (a:Node)-[r:{relation_types.MATCH}]->(b:Node) WHERE r.coma IS NULL "
+            "WITH r, id(r) as relation_id, a.source_path as from_path, b.source_path as to_path "
+            f"CALL {{ WITH r DELETE r }} IN TRANSACTIONS OF {int(batch_size)} ROWS "
+            "RETURN relation_id, from_path, to_path"))
+    table_paths = {record["from_path"] for record in records} | {record["to_path"] for record in records}
+    if table_paths:
+        redis_tools.bump_graph_version(sorted(table_paths))
+    return [record["relation_id"] for record in records]
 
 
 def delete_relation_by_id(relation_id):
     with neo.get_client().session() as session:
         result = session.write_transaction(_delete_relation_by_id, relation_id)
+    redis_tools.bump_graph_version()
     return result
 
 
-def shortest_path_between_tables(from_table, to_table):
+def get_table_relations():
+    # Read from the leader, like the rows of the graph snapshot, since a replica may lag behind the graph version
+    with neo.get_client().session() as session:
+        relations = session.write_transaction(_get_table_relations)
+    return relations
+
+
+def get_related_rows(table_paths=None):
+    # Read from the leader, since the graph snapshot of a version has to see all writes up to that version
+    with neo.get_client().session() as session:
+        rows = session.write_transaction(_get_related_rows, table_paths)
+    return rows
+
+
+def refresh_unweighted_table_relations():
+    with neo.get_client().session() as session:
+        count = session.write_transaction(_refresh_unweighted_table_relations)
+    # Only the table-level projection changed
+    redis_tools.bump_graph_version([])
+    return count
+
+
+def rebuild_table_relations():
     with neo.get_client().session() as session:
-        result = session.write_transaction(_shortest_path_between_tables, from_table, to_table)
+        count = session.write_transaction(_rebuild_table_relations)
+    if count > 0:
+        redis_tools.bump_graph_version([])
+    return count
+
+
+def shortest_path_between_tables(from_table, to_table):
+    with neo.read_session() as session:
+        result = session.read_transaction(_shortest_path_between_tables, from_table, to_table)
     return result
 
 
@@ -75,6 +139,47 @@ def _create_relation(tx, a_id, b_id, relation_name):
     return result
 
 
+def _create_relations(tx, relation_name, rows):
+    tx_result = tx.run("UNWIND $rows AS row "
+                       "MATCH (a:Node {id: row.from_id}) "
+                       "MATCH (b:Node {id: row.to_id}) "
+                       f"MERGE (a)-[r:{relation_name}]-(b) "
+                       "SET r += row.props "
+                       "RETURN count(r) as count, "
+                       "collect(DISTINCT a.source_path) + collect(DISTINCT b.source_path) as table_paths", rows=rows)
+    record = tx_result.single()
+
+    if relation_name == relation_types.MATCH:
+        # Keep the table-level projection up to date with the matches between the columns
+        tx.run("UNWIND $rows AS row "
+               "MATCH (a:Node {id: row.from_id}) "
+               "MATCH (b:Node {id: row.to_id}) "
+               "WITH a.source_path AS from_path, b.source_path AS to_path "
+               + _REFRESH_TABLE_RELATIONS, rows=rows).consume()
+    return record['count'], record['table_paths']
+
+
+# Recomputes the table-level relations between the from_path and to_path tables from the matches between their
+# columns: the best match becomes the weighted relation, and tables without any match are no longer related
+_REFRESH_TABLE_RELATIONS = (
+    "WITH DISTINCT CASE WHEN from_path < to_path THEN [from_path, to_path] ELSE [to_path, from_path] END AS pair "
+    "WHERE pair[0] <> pair[1] "
+    "MERGE (ta:Table {path: pair[0]}) ON CREATE SET ta.name = last(split(pair[0], '/')) "
+    "MERGE (tb:Table {path: pair[1]}) ON CREATE SET tb.name = last(split(pair[1], '/')) "
+    "WITH ta, tb "
+    f"OPTIONAL MATCH (a:Node {{source_path: ta.path}})-[r:{relation_types.MATCH}]-(b:Node {{source_path: tb.path}}) "
+    "WITH ta, tb, a, b, r ORDER BY coalesce(r.coma, 0.0) DESC "
+    "WITH ta, tb, collect(CASE WHEN r IS NULL THEN NULL "
+    "ELSE {weight: coalesce(r.coma, 0.0), from_id: a.id, to_id: b.id} END)[0] AS best "
+    f"OPTIONAL MATCH (ta)-[old:{relation_types.TABLE_RELATED}]-(tb) "
+    "DELETE old "
+    "WITH DISTINCT ta, tb, best WHERE best IS NOT NULL "
+    f"CREATE (ta)-[t:{relation_types.TABLE_RELATED}]->(tb) "
+    "SET t += best "
+    "RETURN count(t) as count"
+)
+
+
 def _set_properties(tx, a_id, b_id, relation_name, **kwargs):
     set_query = 'SET '
     for i, key in enumerate(kwargs.keys()):
@@ -82,7 +187,7 @@ def _set_properties(tx, a_id, b_id, relation_name, **kwargs):
         if i < len(kwargs.keys()) - 1:
             set_query += ', '
 
-    tx_result = tx.run("MATCH (a:Node)-[r:{}]->(b:Node) WHERE a.id = $a_id and b.id = $b_id {} RETURN r as relation"
+    tx_result = tx.run("MATCH (a:Node {{id: $a_id}})-[r:{}]->(b:Node {{id: $b_id}}) {} RETURN r as relation"
                        .format(relation_name, set_query), a_id=a_id, b_id=b_id, **kwargs)
     result = []
     for record in tx_result:
@@ -91,7 +196,7 @@ def _set_properties(tx, a_id, b_id, relation_name, **kwargs):
 
 
 def _delete_relation_between_nodes(tx, node_id1, node_id2, relation_name):
-    result = tx.run("MATCH (a:Node)-[r:{}]->(b:Node) WHERE a.id = $a_id AND b.id = $b_id DELETE r"
+    result = tx.run("MATCH (a:Node {{id: $a_id}})-[r:{}]->(b:Node {{id: $b_id}}) DELETE r"
                     .format(relation_name), a_id=node_id1, b_id=node_id2)
     return result.single()
 
@@ -101,13 +206,14 @@ def _delete_relations_by_name(tx, relation_name):
     return result.single()
 
 
-def _get_related_relations(tx):
-    tx_result = tx.run("match (n)-[r:RELATED]-(m) with r.coma as coma, r as relation return count(coma) as coma, relation as result")
-
-    result = []
-    for record in tx_result:
-        result.append(record.values())
-    return result
+def _delete_table_relations(tx, table_path):
+    tx_result = tx.run(f"MATCH (n:Node {{source_path: $table_path}})-[r:{relation_types.MATCH}]-(:Node) "
+                       "DELETE r "
+                       "RETURN count(r) as count", table_path=table_path)
+    count = tx_result.single()['count']
+    tx.run(f"MATCH (:Table {{path: $table_path}})-[t:{relation_types.TABLE_RELATED}]-(:Table) "
+           "DELETE t", table_path=table_path).consume()
+    return count
 
 
 def _delete_relation_by_id(tx, relation_id):
@@ -115,9 +221,46 @@ def _delete_relation_by_id(tx, relation_id):
     return tx_result.single()
 
 
+def _get_table_relations(tx):
+    tx_result = tx.run(f"MATCH (a:Table)-[t:{relation_types.TABLE_RELATED}]->(b:Table) "
+                       "RETURN a.path as from_path, b.path as to_path, t.weight as weight, "
+                       "t.from_id as from_id, t.to_id as to_id")
+    return [record.data() for record in tx_result]
+
+
+def _get_related_rows(tx, table_paths):
+    # Either the relations of the columns of the given tables, or all relations
+    if table_paths is None:
+        query = f"MATCH (a:Node)-[r:{relation_types.MATCH}]->(b:Node) "
+    else:
+        query = ("MATCH (n:Node) WHERE n.source_path IN $table_paths "
+                 f"MATCH (n)-[r:{relation_types.MATCH}]-(:Node) "
+                 "WITH DISTINCT r MATCH (a:Node)-[r]->(b:Node) ")
+    tx_result = tx.run(query + "RETURN id(r) as relation_id, a.id as a_id, b.id as b_id, r.coma as coma, "
+                               "r.from_id as from_id, r.to_id as to_id", table_paths=table_paths)
+    return [record.values() for record in tx_result]
+
+
+def _refresh_unweighted_table_relations(tx):
+    # Relations without a score are the only ones that can disappear when the spurious connections are deleted
+    tx_result = tx.run(f"MATCH (ta:Table)-[t:{relation_types.TABLE_RELATED}]->(tb:Table) "
+                       "WHERE t.weight = 0.0 "
+                       "WITH ta.path AS from_path, tb.path AS to_path "
+                       + _REFRESH_TABLE_RELATIONS)
+    return tx_result.single()['count']
+
+
+def _rebuild_table_relations(tx):
+    tx_result = tx.run(f"MATCH (a:Node)-[:{relation_types.MATCH}]-(b:Node) "
+                       "WHERE a.source_path < b.source_path "
+                       "WITH DISTINCT a.source_path AS from_path, b.source_path AS to_path "
+                       + _REFRESH_TABLE_RELATIONS)
+    return tx_result.single()['count']
+
+
 def _shortest_path_between_tables(tx, from_table, to_table):
-    tx_result = tx.run("match (n {source_path: $from_table}), "
-                       "(m {source_path: $to_table}), "
+    tx_result = tx.run("match (n:Node {source_path: $from_table}), "
+                       "(m:Node {source_path: $to_table}), "
                        "p=shortestPath((n)-[r:RELATED|SIBLING*]-(m)) "
                        "return p", from_table=from_table, to_table=to_table)
 
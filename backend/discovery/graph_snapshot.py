@@ -0,0 +1,182 @@
+import os
+import threading
+# Typing
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from . import edge_helper, node_helper
+from ..search import redis_tools
+
+# Whether the read endpoints are served from an in-memory snapshot of the graph instead of querying Neo4j
+ENABLED = os.environ.get("GRAPH_SNAPSHOT", "true").lower() == "true"
+
+NODE_FIELDS = ("id", "source_path", "source_name", "asset_id")
+RELATION_FIELDS = ("relation_id", "a_id", "b_id", "coma", "from_id", "to_id")
+
+
+def _columns(rows: List[List[Any]], fields: tuple) -> Dict[str, np.ndarray]:
+    columns = {}
+    for i, field in enumerate(fields):
+        values = np.empty(len(rows), dtype=object)
+        values[:] = [row[i] for row in rows]
+        columns[field] = values
+    return columns
+
+
+class GraphSnapshot:
+    """
+    Read-only snapshot of the column graph at a given version, in compact arrays.
+
+    Every node refers to its table by index, and the RELATED relations are an edge list with their scores, from which a
+    CSR adjacency is derived: the neighbours of node i are indices[indptr[i]:indptr[i + 1]], reached over the relations
+    edges[indptr[i]:indptr[i + 1]]. Snapshots are never modified, refreshing one creates a new snapshot.
+    """
+
+    def __init__(self, version: int, nodes: Dict[str, np.ndarray], relations: Dict[str, np.ndarray]):
+        self.version = version
+        self.nodes = nodes
+        self.node_index = {node_id: i for i, node_id in enumerate(nodes["id"])}
+
+        self.table_paths, first_nodes, self.node_tables = np.unique(nodes["source_path"].astype(str),
+                                                                    return_index=True, return_inverse=True)
+        self.table_index = {table_path: i for i, table_path in enumerate(self.table_paths)}
+        self.table_names = nodes["source_name"][first_nodes]
+        self.table_assets = nodes["asset_id"][first_nodes]
+
+        # Relations of which a node is missing were written while the snapshot was taken, they are picked up later
+        src = np.array([self.node_index.get(node_id, -1) for node_id in relations["a_id"]], dtype=np.int64)
+        dst = np.array([self.node_index.get(node_id, -1) for node_id in relations["b_id"]], dtype=np.int64)
+        known = (src >= 0) & (dst >= 0)
+        self.relations = {field: values[known] for field, values in relations.items()}
+        self.src = src[known]
+        self.dst = dst[known]
+        self.coma = np.array([np.nan if coma is None else coma for coma in self.relations["coma"]], dtype=np.float64)
+
+        both_src = np.concatenate([self.src, self.dst])
+        order = np.argsort(both_src, kind="stable")
+        self.indices = np.concatenate([self.dst, self.src])[order]
+        self.edges = np.tile(np.arange(len(self.src)), 2)[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(both_src, minlength=len(self.node_index)))])
+
+    @classmethod
+    def load(cls, version: int) -> "GraphSnapshot":
+        return cls(version, _columns(node_helper.get_node_rows(), NODE_FIELDS),
+                   _columns(edge_helper.get_related_rows(), RELATION_FIELDS))
+
+    def refresh(self, version: int, table_paths: List[str]) -> "GraphSnapshot":
+        """
+        Gets the snapshot at the given version, in which only the nodes and relations of the given tables changed.
+        """
+        if not table_paths:
+            return GraphSnapshot(version, self.nodes, self.relations)
+
+        nodes = _columns(node_helper.get_node_rows(table_paths), NODE_FIELDS)
+        relations = _columns(edge_helper.get_related_rows(table_paths), RELATION_FIELDS)
+
+        changed_tables = np.array([self.table_index[table_path] for table_path in table_paths
+                                   if table_path in self.table_index], dtype=np.int64)
+        kept_nodes = ~np.isin(self.node_tables, changed_tables)
+        # Relations of the changed tables are all reloaded, only those between unchanged tables are kept
+        kept_relations = kept_nodes[self.src] & kept_nodes[self.dst]
+        return GraphSnapshot(
+            version,
+            {field: np.concatenate([values[kept_nodes], nodes[field]]) for field, values in self.nodes.items()},
+            {field: np.concatenate([values[kept_relations], relations[field]])
+             for field, values in self.relations.items()})
+
+    def _neighbourhood(self, sources: np.ndarray):
+        # Unrolls the CSR rows of the given nodes into (node, neighbour, relation) arrays
+        starts = self.indptr[sources]
+        counts = self.indptr[sources + 1] - starts
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+        positions = offsets + np.arange(counts.sum())
+        return np.repeat(sources, counts), self.indices[positions], self.edges[positions]
+
+    def joinable_tables(self, table_paths: List[str], filter_pids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Gets the same ranked joinable tables as node_helper.get_joinable_tables, without a cursor or limit.
+        """
+        source_tables = np.array([self.table_index[table_path] for table_path in table_paths
+                                  if table_path in self.table_index], dtype=np.int64)
+        if len(source_tables) == 0:
+            return []
+
+        active_pids = set(filter_pids)
+        allowed_tables = np.array([asset_id in active_pids for asset_id in self.table_assets], dtype=bool)
+        allowed_tables[source_tables] = False
+
+        from_nodes, to_nodes, edges = self._neighbourhood(np.flatnonzero(np.isin(self.node_tables, source_tables)))
+        to_tables = self.node_tables[to_nodes]
+        allowed = allowed_tables[to_tables]
+        from_nodes, to_tables, edges = from_nodes[allowed], to_tables[allowed], edges[allowed]
+        scores = np.nan_to_num(self.coma[edges], nan=0.0)
+
+        # The best relation of every source column per joinable table, in descending order of score
+        order = np.lexsort((-scores, to_tables, from_nodes))
+        from_nodes, to_tables, edges, scores = from_nodes[order], to_tables[order], edges[order], scores[order]
+        best = np.concatenate([[True], (from_nodes[1:] != from_nodes[:-1]) | (to_tables[1:] != to_tables[:-1])])
+        from_nodes, to_tables, edges, scores = from_nodes[best], to_tables[best], edges[best], scores[best]
+        order = np.lexsort((-scores, to_tables))
+        from_nodes, to_tables, edges, scores = from_nodes[order], to_tables[order], edges[order], scores[order]
+
+        records = []
+        tables, starts, counts = np.unique(to_tables, return_index=True, return_counts=True)
+        for table, start, count in zip(tables, starts, counts):
+            matches = [{
+                "table_name": self.table_names[table],
+                "source_path": str(self.table_paths[self.node_tables[from_node]]),
+                "from_id": self.relations["from_id"][edge],
+                "to_id": self.relations["to_id"][edge],
+                "coma": None if np.isnan(self.coma[edge]) else float(self.coma[edge]),
+            } for from_node, edge in zip(from_nodes[start:start + count], edges[start:start + count])]
+            records.append({"table_path": str(self.table_paths[table]), "table_name": self.table_names[table],
+                            "matches": matches, "match_count": int(count),
+                            "mean_coma": float(scores[start:start + count].mean())})
+        return sorted(records, key=lambda r: (-r["match_count"], -r["mean_coma"], r["table_path"]))
+
+    def table_relations(self) -> List[Dict[str, Any]]:
+        """
+        Gets the table-level projection: the best relation between the columns of every pair of related tables.
+        """
+        src_tables = self.node_tables[self.src]
+        dst_tables = self.node_tables[self.dst]
+        between = src_tables != dst_tables
+        # Orient every relation from the table with the lowest index to the other one
+        swap = src_tables > dst_tables
+        from_nodes = np.where(swap, self.dst, self.src)[between]
+        to_nodes = np.where(swap, self.src, self.dst)[between]
+        from_tables = self.node_tables[from_nodes]
+        to_tables = self.node_tables[to_nodes]
+        weights = np.nan_to_num(self.coma[between], nan=0.0)
+
+        order = np.lexsort((-weights, to_tables, from_tables))
+        best = order[np.concatenate([[True], (from_tables[order][1:] != from_tables[order][:-1]) |
+                                     (to_tables[order][1:] != to_tables[order][:-1])])] if len(order) else order
+        return [{"from_path": str(self.table_paths[from_tables[i]]), "to_path": str(self.table_paths[to_tables[i]]),
+                 "weight": float(weights[i]), "from_id": self.nodes["id"][from_nodes[i]],
+                 "to_id": self.nodes["id"][to_nodes[i]]} for i in best]
+
+
+_snapshot: Optional[GraphSnapshot] = None
+_lock = threading.Lock()
+
+
+def get_snapshot() -> GraphSnapshot:
+    """
+    Gets the snapshot of the current graph. Once the graph changed, only the changed tables are loaded again,
+    unless it is unknown what changed.
+    """
+    global _snapshot
+    version = redis_tools.get_graph_version()
+    if _snapshot is None or _snapshot.version != version:
+        with _lock:
+            if _snapshot is None:
+                _snapshot = GraphSnapshot.load(version)
+            elif _snapshot.version != version:
+                changed = redis_tools.get_graph_changes(_snapshot.version)
+                if changed is None:
+                    _snapshot = GraphSnapshot.load(version)
+                else:
+                    _snapshot = _snapshot.refresh(version, changed)
+    return _snapshot
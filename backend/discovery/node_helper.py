@@ -1,13 +1,29 @@
 from . import relation_types
 from ..clients import neo4j as neo
+from ..search import redis_tools
 
 
 def create_node(asset_id, source, source_path, label):
     with neo.get_client().session() as session:
         node = session.write_transaction(_create_node, asset_id, source, source_path, label)
+    redis_tools.bump_graph_version([source_path])
     return node
 
 
+def create_nodes(asset_id, source, source_path, labels_with_props):
+    with neo.get_client().session() as session:
+        nodes = session.write_transaction(_create_nodes, asset_id, source, source_path, labels_with_props)
+    redis_tools.bump_graph_version([source_path])
+    return nodes
+
+
+def update_nodes(source_path, labels_with_props):
+    with neo.get_client().session() as session:
+        nodes = session.write_transaction(_update_nodes, source_path, labels_with_props)
+    redis_tools.bump_graph_version([source_path])
+    return nodes
+
+
 def set_profiling_props(node_id, **kwargs):
     with neo.get_client().session() as session:
         node = session.write_transaction(_set_profiling_properties, node_id, **kwargs)
@@ -15,44 +31,72 @@ def set_profiling_props(node_id, **kwargs):
 
 
 def get_all():
-    with neo.get_client().session() as session:
-        nodes = session.write_transaction(_get_all)
+    with neo.read_session() as session:
+        nodes = session.read_transaction(_get_all)
     return nodes
 
 
 def get_node(**kwargs):
-    with neo.get_client().session() as session:
-        node = session.write_transaction(_get_node, **kwargs)
+    with neo.read_session() as session:
+        node = session.read_transaction(_get_node, **kwargs)
     return node
 
 
 def get_nodes_path_contains(contained_word):
-    with neo.get_client().session() as session:
-        node = session.write_transaction(_get_nodes_path_contains, contained_word)
+    with neo.read_session() as session:
+        node = session.read_transaction(_get_nodes_path_contains, contained_word)
     return node
 
 
-def get_related_nodes(node_id):
-    with neo.get_client().session() as session:
-        nodes = session.write_transaction(_get_related_nodes, node_id)
-    return nodes
+def get_table_paths_by_asset_id(asset_id):
+    with neo.read_session() as session:
+        table_paths = session.read_transaction(_get_table_paths_by_asset_id, asset_id)
+    return table_paths
+
+
+def get_table_paths_by_asset_ids(asset_ids):
+    with neo.read_session() as session:
+        table_paths = session.read_transaction(_get_table_paths_by_asset_ids, asset_ids)
+    return table_paths
 
 
-def get_joinable(node_id, filter_pids):
+def get_node_rows(table_paths=None):
+    # Read from the leader, since the graph snapshot of a version has to see all writes up to that version
     with neo.get_client().session() as session:
-        nodes = session.write_transaction(_get_joinable, node_id, filter_pids)
+        rows = session.write_transaction(_get_node_rows, table_paths)
+    return rows
+
+
+def get_related_nodes(node_id):
+    with neo.read_session() as session:
+        nodes = session.read_transaction(_get_related_nodes, node_id)
     return nodes
 
 
+def get_joinable_tables(table_paths, filter_pids, limit=None, after=None):
+    with neo.read_session() as session:
+        tables = session.read_transaction(_get_joinable_tables, table_paths, filter_pids, limit, after)
+    return tables
+
+
+def iter_joinable_tables(table_paths, filter_pids, limit=None, after=None):
+    # An auto-commit query streams its records lazily, so they can be passed on while Neo4j still sends them. The
+    # records outlive the request that started the stream, so it cannot use the read session of the request.
+    with neo.get_client().session(default_access_mode=neo.READ_ACCESS) as session:
+        for record in session.run(_joinable_tables_query(limit=limit is not None), table_paths=table_paths,
+                                  filter_pids=filter_pids, limit=limit, after=after):
+            yield record.data()
+
+
 def get_siblings(node_id):
-    with neo.get_client().session() as session:
-        nodes = session.write_transaction(_get_siblings, node_id)
+    with neo.read_session() as session:
+        nodes = session.read_transaction(_get_siblings, node_id)
     return nodes
 
 
 def get_nodes_by_table_path(source_path):
-    with neo.get_client().session() as session:
-        nodes = session.write_transaction(_get_nodes_by_table_path, source_path)
+    with neo.read_session() as session:
+        nodes = session.read_transaction(_get_nodes_by_table_path, source_path)
     return nodes
 
 
@@ -71,24 +115,33 @@ def delete_all_properties(node_id):
 def delete_relation(node_id, relation):
     with neo.get_client().session() as session:
         node = session.write_transaction(_delete_relation_from_node, node_id, relation)
+    redis_tools.bump_graph_version()
     return node
 
 
 def delete_node_and_all_relations(node_id):
     with neo.get_client().session() as session:
         node = session.write_transaction(_delete_node_and_all_relations, node_id)
+    redis_tools.bump_graph_version()
     return node
 
 
+def delete_nodes_by_table_path(source_path):
+    with neo.get_client().session() as session:
+        count = session.write_transaction(_delete_nodes_by_table_path, source_path)
+    redis_tools.bump_graph_version([source_path])
+    return count
+
+
 def delete_all():
     with neo.get_client().session() as session:
         node = session.write_transaction(_delete_all)
+    redis_tools.bump_graph_version()
     return node
 
 
 def _get_nodes_by_table_path(tx, source_path):
-    tx_result = tx.run("MATCH (n) "
-                       "WHERE n.source_path = $source_path "
+    tx_result = tx.run("MATCH (n:Node {source_path: $source_path}) "
                        "RETURN n as result", source_path=source_path)
 
     result = []
@@ -98,8 +151,7 @@ def _get_nodes_by_table_path(tx, source_path):
 
 
 def _get_siblings(tx, node_id):
-    tx_result = tx.run(f"MATCH (a:Node)-[r:{relation_types.SIBLING}]-(b:Node) "
-                       "WHERE a.id = $node_id "
+    tx_result = tx.run(f"MATCH (a:Node {{id: $node_id}})-[r:{relation_types.SIBLING}]-(b:Node) "
                        "RETURN b as result", node_id=node_id)
 
     result = []
@@ -108,21 +160,35 @@ def _get_siblings(tx, node_id):
     return result
 
 
-def _get_joinable(tx, node_id, filter_pids):
-    tx_result = tx.run(f"MATCH (a:Node)-[r:{relation_types.FOREIGN_KEY_IND}]-(b:Node) "
-                       "WHERE a.id = $node_id AND "
-                       "b.asset_id in $filter_pids "
-                       "RETURN b, r as result", node_id=node_id, filter_pids=filter_pids)
-
-    result = []
-    for record in tx_result:
-        result.append(record['result'])
-    return result
+def _joinable_tables_query(limit):
+    # Every column of the given tables contributes its best match per joinable table, the tables are ranked by the
+    # number of matching columns and their mean score. The ranking key of the last table of a page is the cursor.
+    return (f"MATCH (a:Node)-[r:{relation_types.FOREIGN_KEY_IND}]-(b:Node) "
+            "WHERE a.source_path IN $table_paths AND b.asset_id IN $filter_pids "
+            "AND NOT b.source_path IN $table_paths "
+            "WITH a, b, r ORDER BY coalesce(r.coma, 0.0) DESC "
+            "WITH a, b.source_path AS table_path, "
+            "collect({table_name: b.source_name, source_path: a.source_path, from_id: r.from_id, to_id: r.to_id, "
+            "coma: r.coma})[0] AS match "
+            "WITH table_path, match ORDER BY coalesce(match.coma, 0.0) DESC "
+            "WITH table_path, collect(match) AS matches "
+            "WITH table_path, matches[0].table_name AS table_name, matches, size(matches) AS match_count, "
+            "reduce(total = 0.0, m IN matches | total + coalesce(m.coma, 0.0)) / size(matches) AS mean_coma "
+            "WHERE $after IS NULL OR match_count < $after.match_count "
+            "OR (match_count = $after.match_count AND (mean_coma < $after.mean_coma "
+            "OR (mean_coma = $after.mean_coma AND table_path > $after.table_path))) "
+            "RETURN table_path, table_name, matches, match_count, mean_coma "
+            "ORDER BY match_count DESC, mean_coma DESC, table_path" + (" LIMIT $limit" if limit else ""))
+
+
+def _get_joinable_tables(tx, table_paths, filter_pids, limit, after):
+    tx_result = tx.run(_joinable_tables_query(limit=limit is not None), table_paths=table_paths,
+                       filter_pids=filter_pids, limit=limit, after=after)
+    return [record.data() for record in tx_result]
 
 
 def _get_related_nodes(tx, node_id):
-    tx_result = tx.run("MATCH (a:Node)-[r:MATCH]-(b:Node) "
-                       "WHERE a.id = $node_id "
+    tx_result = tx.run("MATCH (a:Node {id: $node_id})-[r:MATCH]-(b:Node) "
                        "RETURN b, r as result", node_id=node_id)
     result = []
     for record in tx_result:
@@ -144,6 +210,32 @@ def _create_node(tx, asset_id, source, source_path, label):
     return result
 
 
+def _create_nodes(tx, asset_id, source, source_path, labels_with_props):
+    rows = [{'label': label, 'props': props} for label, props in labels_with_props.items()]
+    tx_result = tx.run("UNWIND $rows AS row "
+                       "CREATE (n:Node) "
+                       "SET n += row.props, "
+                       "n.id = $source_path + '/' + row.label, "
+                       "n.name = row.label, "
+                       "n.source_name = $source, "
+                       "n.source_path = $source_path, "
+                       "n.asset_id = $asset_id "
+                       "RETURN n as node", rows=rows, asset_id=asset_id, source=source, source_path=source_path)
+    result = []
+    for record in tx_result:
+        result.append(record['node'])
+    return result
+
+
+def _update_nodes(tx, source_path, labels_with_props):
+    rows = [{'label': label, 'props': props} for label, props in labels_with_props.items()]
+    tx_result = tx.run("UNWIND $rows AS row "
+                       "MATCH (n:Node {id: $source_path + '/' + row.label}) "
+                       "SET n += row.props "
+                       "RETURN n as node", rows=rows, source_path=source_path)
+    return [record['node'] for record in tx_result]
+
+
 def _set_profiling_properties(tx, node_id, **kwargs):
     set_query = 'SET '
     for i, key in enumerate(kwargs.keys()):
@@ -151,7 +243,7 @@ def _set_profiling_properties(tx, node_id, **kwargs):
         if i < len(kwargs.keys()) - 1:
             set_query += ', '
 
-    tx_result = tx.run("MATCH (n:Node) WHERE n.id = $id {} RETURN n as node".format(set_query), id=node_id, **kwargs)
+    tx_result = tx.run("MATCH (n:Node {{id: $id}}) {} RETURN n as node".format(set_query), id=node_id, **kwargs)
     result = []
     for record in tx_result:
         print(record)
@@ -168,7 +260,7 @@ def _get_all(tx):
 
 
 def _get_nodes_path_contains(tx, contained_word):
-    tx_result = tx.run("match (n) where n.source_path contains $contained_word return count(n), n.source_path as node",
+    tx_result = tx.run("match (n:Node) where n.source_path contains $contained_word return distinct n.source_path as node",
                        contained_word=contained_word)
 
     result = []
@@ -178,14 +270,42 @@ def _get_nodes_path_contains(tx, contained_word):
     return result
 
 
+def _get_table_paths_by_asset_id(tx, asset_id):
+    tx_result = tx.run("MATCH (n:Node {asset_id: $asset_id}) "
+                       "RETURN DISTINCT n.source_path as table_path", asset_id=asset_id)
+
+    result = []
+    for record in tx_result:
+        result.append(record['table_path'])
+
+    return result
+
+
+def _get_table_paths_by_asset_ids(tx, asset_ids):
+    tx_result = tx.run("UNWIND $asset_ids AS asset_id "
+                       "MATCH (n:Node {asset_id: asset_id}) "
+                       "RETURN asset_id, collect(DISTINCT n.source_path) as table_paths", asset_ids=asset_ids)
+
+    result = {}
+    for record in tx_result:
+        result[record['asset_id']] = record['table_paths']
+    return result
+
+
+def _get_node_rows(tx, table_paths):
+    # Either the nodes of the given tables, or all nodes
+    where = "WHERE n.source_path IN $table_paths " if table_paths is not None else ""
+    tx_result = tx.run("MATCH (n:Node) " + where +
+                       "RETURN n.id as id, n.source_path as source_path, n.source_name as source_name, "
+                       "n.asset_id as asset_id", table_paths=table_paths)
+    return [record.values() for record in tx_result]
+
+
 def _get_node(tx, **kwargs):
-    where_query = ''
-    for i, key in enumerate(kwargs.keys()):
-        where_query += 'WHERE n.{} = ${} '.format(key, key)
-        if i < len(kwargs.keys()) - 1:
-            where_query += ' AND '
+    # Inline property map, so the lookup can use the indexes on id, source_path and asset_id
+    props_query = ', '.join('{}: ${}'.format(key, key) for key in kwargs.keys())
 
-    tx_result = tx.run("MATCH (n:Node) {} RETURN n as node".format(where_query), **kwargs)
+    tx_result = tx.run("MATCH (n:Node {{{}}}) RETURN n as node".format(props_query), **kwargs)
 
     result = []
     for record in tx_result:
@@ -195,13 +315,9 @@ def _get_node(tx, **kwargs):
 
 
 def _delete_property(tx, remove_prop, **kwargs):
-    where_query = ''
-    for i, key in enumerate(kwargs.keys()):
-        where_query += 'WHERE n.{} = ${} '.format(key, key)
-        if i < len(kwargs.keys()) - 1:
-            where_query += ' AND '
+    props_query = ', '.join('{}: ${}'.format(key, key) for key in kwargs.keys())
 
-    tx_result = tx.run("MATCH (n:Node) {} REMOVE n.{} RETURN n as node".format(where_query, remove_prop), **kwargs)
+    tx_result = tx.run("MATCH (n:Node {{{}}}) REMOVE n.{} RETURN n as node".format(props_query, remove_prop), **kwargs)
     result = []
     for record in tx_result:
         result.append(record['node'])
@@ -209,24 +325,35 @@ def _delete_property(tx, remove_prop, **kwargs):
 
 
 def _delete_all_properties(tx, node_id):
-    result = tx.run("MATCH (n {id: $id}) "
+    result = tx.run("MATCH (n:Node {id: $id}) "
                     "SET n = {} "
                     "RETURN n", id=node_id)
     return result.single()
 
 
 def _delete_relation_from_node(tx, node_id, relation):
-    result = tx.run("MATCH (n {id: $id})-[r:$relation]->()"
+    result = tx.run("MATCH (n:Node {id: $id})-[r:$relation]->()"
                     "DELETE r", id=node_id, relation=relation)
     return result.single()
 
 
 def _delete_node_and_all_relations(tx, node_id):
-    result = tx.run("MATCH (n {id: $id})"
+    result = tx.run("MATCH (n:Node {id: $id})"
                     "DETACH DELETE n", id=node_id)
     return result.single()
 
 
+def _delete_nodes_by_table_path(tx, source_path):
+    result = tx.run("MATCH (n:Node {source_path: $source_path}) "
+                    "DETACH DELETE n "
+                    "RETURN count(n) as count", source_path=source_path)
+    count = result.single()['count']
+    # The relations of the table in the table-level projection are gone with its columns
+    tx.run("MATCH (t:Table {path: $source_path}) "
+           "DETACH DELETE t", source_path=source_path).consume()
+    return count
+
+
 def _delete_all(tx):
     result = tx.run("MATCH (n)"
                     "DETACH DELETE n")
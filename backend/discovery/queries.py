@@ -1,13 +1,13 @@
+import base64
+import json
 import logging
-from typing import Dict, Any, List
-
-import numpy as np
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
 from . import edge_helper
+from . import graph_snapshot
 from . import node_helper
-from .edge_helper import shortest_path_between_tables
-from .relation_types import MATCH
-from .utilities import process_relation, process_node
+from . import table_graph
+from .utilities import process_relation
 from ..utility import ROOT_FOLDER
 from ..utility.display import log_format
 
@@ -52,98 +52,141 @@ def get_related_nodes(node_id: str):
     return related_nodes
 
 
-def get_joinable(table: Dict[str, Any]):
-    table_path = table['path']
-    table_name = table['name']
-    # Get all the nodes belonging to the given table
-    nodes = node_helper.get_nodes_by_table_path(table_path)
-    # Simplify the object (only keep the table path, column name and column id)
-    siblings = process_node(nodes)
+def get_joinable(table: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Gets the tables that are joinable with the given table, ranked by the number of joinable columns and their mean
+    score. A single query gets the best match of every column per joinable table, already grouped and ranked by Neo4j,
+    or by the graph snapshot if that is enabled.
+    """
+    records = _get_joinable_records([table['path']])
+    logging.info(f"Joinable tables of {table['path']}: {len(records)}")
+    return [_to_joinable_table(record) for record in records]
+
+
+def _active_pids() -> List[str]:
     with open(ROOT_FOLDER / 'pids-of-active-assets.txt') as f:
-        active_pids = [line.rstrip('\n') for line in f]
-    logging.info(f"Active pids: {len(active_pids)}")
-    joinable_tables = {}
-    for sib in siblings:
-        # Get all the nodes connected to a sibling via RELATED edge
-        related_nodes = node_helper.get_joinable(sib['id'], active_pids)
-        logging.info(f"Sibling: {sib['id']}\n\tRELATED NODES: {len(related_nodes)}")
-        # If the node has connection, transform the result into something useful for us
-        # { table_name: {PK: { from_id: <id>, to_id: <id> }, RELATED: <threshold>} ... }
-        if len(related_nodes) > 0:
-            tables = process_relation(table_path, table_name, related_nodes)
-            for related_table in tables:
-                related_table_name = related_table["table_name"]
-                related_table_path = related_table["table_path"]
-                if related_table_path not in joinable_tables:
-                    joinable_tables[related_table_path] = {"matches": []}
-                related_table.pop("table_path")  # We move this one level up
-                joinable_tables[related_table_path]["matches"].append(
-                    related_table)
-                joinable_tables[related_table_path]["table_name"] = related_table_name
-                joinable_tables[related_table_path]["table_path"] = related_table_path
-            # print(len(joinable_tables[related_table_path]["matches"]))
-            joinable_tables[related_table_path]["matches"] = list(
-                sorted(joinable_tables[related_table_path]["matches"],
-                       key=lambda x: -x["RELATED"]["coma"] if "coma" in x["RELATED"] else 0))
-
-    joinable_tables_sorted = sorted(list(joinable_tables.values()), key=lambda x: (
-        -len(x["matches"]), -np.mean([x["RELATED"]["coma"] if "coma" in x["RELATED"] else 0 for x in x["matches"]])))
-
-    return joinable_tables_sorted
-
-
-def delete_spurious_connections():
-    # Get all relations ([ [nr of coma properties, relations] ])
-    relations = edge_helper.get_related_relations()
-    # Filter out the relations with coma (aka Valentine matcher) property
-    no_match_relations = list(
-        map(lambda x: x[1], filter(lambda x: x[0] == 0, relations)))
-    # For each relation, get the id and delete it
-    ids = []
-    for relation in no_match_relations:
-        ids.append(relation.id)
-        edge_helper.delete_relation_by_id(relation.id)
+        return [line.rstrip('\n') for line in f]
+
+
+def _rank_key(record: Dict[str, Any]) -> Tuple[int, float, str]:
+    return -record["match_count"], -record["mean_coma"], record["table_path"]
+
+
+def _get_joinable_records(table_paths: List[str], limit: Optional[int] = None,
+                          after: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    if not graph_snapshot.ENABLED:
+        return node_helper.get_joinable_tables(table_paths, _active_pids(), limit, after)
+    records = graph_snapshot.get_snapshot().joinable_tables(table_paths, _active_pids())
+    if after is not None:
+        records = [record for record in records if _rank_key(record) > _rank_key(after)]
+    return records[:limit] if limit is not None else records
+
+
+def _to_joinable_table(record: Dict[str, Any]) -> Dict[str, Any]:
+    # Same format as the tables of get_joinable
+    matches = []
+    for match in record["matches"]:
+        explanation = f"Table {match['source_path']} is joinable with table {match['table_name']}"
+        joinable = {"table_name": match["table_name"]}
+        if match["to_id"] is not None:
+            joinable["PK"] = {'from_id': match['from_id'], 'to_id': match['to_id']}
+            explanation = f"{explanation} via the primary-key foreign-key constraint: PK - {match['from_id']} and " \
+                          f"FK - {match['to_id']}"
+        if match["coma"] is not None:
+            joinable["RELATED"] = {'coma': float(match['coma'])}
+            explanation = f"{explanation} with a confidence threshold of {match['coma']} (1.0 being the best score)"
+        else:
+            joinable["RELATED"] = {}
+        joinable["explanation"] = explanation
+        matches.append(joinable)
+    return {"matches": matches, "table_name": record["table_name"], "table_path": record["table_path"]}
+
+
+def _encode_cursor(record: Dict[str, Any]) -> str:
+    key = {"match_count": record["match_count"], "mean_coma": record["mean_coma"], "table_path": record["table_path"]}
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Decodes a cursor returned by get_joinable_page, raises a ValueError if it is malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {"match_count": int(key["match_count"]), "mean_coma": float(key["mean_coma"]),
+                "table_path": str(key["table_path"])}
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Malformed cursor: {cursor}") from e
+
+
+def get_joinable_page(table_paths: List[str], limit: int,
+                      cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Gets the highest ranked tables that are joinable with the given tables, starting after the given cursor.
+
+    The ranking is the same as get_joinable, but it is computed by Neo4j, which only returns the requested page.
+    Also returns the cursor of the next page, or None if this was the last one.
+    """
+    records = _get_joinable_records(table_paths, limit, decode_cursor(cursor))
+    next_cursor = _encode_cursor(records[-1]) if records and len(records) == limit else None
+    return [_to_joinable_table(record) for record in records], next_cursor
+
+
+def iter_joinable(table_paths: List[str], limit: Optional[int] = None,
+                  cursor: Optional[str] = None) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """
+    Iterates over the ranked tables that are joinable with the given tables, each with the cursor that continues
+    after it, while Neo4j is still sending them.
+    """
+    if graph_snapshot.ENABLED:
+        records = iter(_get_joinable_records(table_paths, limit, decode_cursor(cursor)))
+    else:
+        records = node_helper.iter_joinable_tables(table_paths, _active_pids(), limit, decode_cursor(cursor))
+    for record in records:
+        yield _to_joinable_table(record), _encode_cursor(record)
+
+
+def delete_spurious_connections() -> List[int]:
+    """
+    Deletes the relations without a coma property (aka not confirmed by the Valentine matcher) in batches on the
+    server, and gets the ids of the deleted relations.
+    """
+    ids = edge_helper.delete_unweighted_relations()
+    logging.info(f"Deleted {len(ids)} spurious connections")
+    edge_helper.refresh_unweighted_table_relations()
     return ids
 
 
 def get_related_between_two_tables(from_table: Dict[str, Any], to_table: Dict[str, Any]) -> List[Dict[str, Any]]:
-    from_table_path = from_table['path']
-    from_table_name = from_table['name']
-    to_table_path = to_table['path']
-    to_table_name = to_table['name']
-
-    # Get all shortest path between the two tables
-    paths = shortest_path_between_tables(from_table_path, to_table_path)
-    all_links = []
-    # Each path contains multiple segments
-    # A segment is a relationship between two nodes
-    for path in paths:
-        explanation = f"Table {from_table_name} and table {to_table_name} are connected via the following path:"
-        link = []
-        # Remember the current table, because the traversal is directionless
-        # Therefore, we need to find the start node which matches with the previous end node
-        current_table = from_table_path
-        for relation in path.relationships:
-            # We don't follow the sibling edges, only the match (RELATED)
-
-            if relation.type == MATCH:
-                if current_table in relation.start_node['id']:
-                    explanation = f"{explanation} {relation.start_node['id']} -> {relation.end_node['id']} ->"
-                    link.append(relation.start_node['id'])
-                    link.append(relation.end_node['id'])
-                    current_table = '/'.join(
-                        relation.end_node['id'].split('/')[:-1])
-                else:
-                    explanation = f"{explanation} {relation.end_node['id']} -> {relation.start_node['id']} ->"
-                    link.append(relation.end_node['id'])
-                    link.append(relation.start_node['id'])
-                    current_table = '/'.join(
-                        relation.start_node['id'].split('/')[:-1])
-        # Because of the sibling edges, some paths will be similar to previous
-        connection = {'explanation': explanation, 'links': link}
-        if connection not in all_links:
-            all_links.append(connection)
-    return all_links
+    return get_related_to_targets(from_table, [to_table])[to_table['path']]
+
+
+def get_related_to_targets(from_table: Dict[str, Any],
+                           to_tables: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Gets the connections from the source table to each of the target tables, by target table path.
+
+    The paths to all targets come from a single breadth-first search from the source in the table-level projection,
+    in which every hop is the best match between the columns of two tables.
+    """
+    graph = table_graph.get_table_graph()
+    related = {}
+    for to_table in to_tables:
+        hops = graph.path(from_table['path'], to_table['path'])
+        related[to_table['path']] = [_to_connection(from_table['name'], to_table['name'], hops)] if hops else []
+    return related
+
+
+def _to_connection(from_table_name: str, to_table_name: str, hops: List[table_graph.Hop]) -> Dict[str, Any]:
+    explanation = f"Table {from_table_name} and table {to_table_name} are connected via the following path:"
+    link = []
+    for _, _, relation in hops:
+        explanation = f"{explanation} {relation['from_id']} -> {relation['to_id']} ->"
+        link.append(relation['from_id'])
+        link.append(relation['to_id'])
+    return {'explanation': explanation, 'links': link}
 
 
 def get_siblings(node_id: str):
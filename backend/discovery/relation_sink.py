@@ -0,0 +1,51 @@
+import os
+from collections import defaultdict
+# Typing
+from typing import Any, Dict, List
+
+from . import edge_helper
+
+BATCH_SIZE = int(os.environ.get("RELATION_BATCH_SIZE", 1000))
+
+
+class RelationSink:
+    """
+    Buffers relations and writes them to Neo4j in batches, using a single UNWIND query per batch.
+
+    Use it as a context manager to make sure the remaining relations are flushed, e.g.:
+
+        with RelationSink() as sink:
+            sink.add(from_id, to_id, relation_types.MATCH, coma=0.9)
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE):
+        self.batch_size = batch_size
+        self._buffers: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+    def add(self, from_node_id: str, to_node_id: str, relation_name: str, **kwargs) -> None:
+        """
+        Adds a relation between the given nodes, which is merged with the given properties on the next flush.
+        """
+        buffer = self._buffers[relation_name]
+        buffer.append({"from_id": from_node_id, "to_id": to_node_id, "props": kwargs})
+        if len(buffer) >= self.batch_size:
+            self._flush(relation_name)
+
+    def flush(self) -> None:
+        """
+        Writes all buffered relations.
+        """
+        for relation_name in list(self._buffers):
+            self._flush(relation_name)
+
+    def _flush(self, relation_name: str) -> None:
+        rows = self._buffers.pop(relation_name, [])
+        if rows:
+            edge_helper.create_relations(relation_name, rows)
+
+    def __enter__(self) -> "RelationSink":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self.flush()
@@ -1,3 +1,5 @@
 FOREIGN_KEY_IND: str = "RELATED"
 SIBLING: str = "SIBLING"
 MATCH: str = "RELATED"
+# Between the table vertices of the table-level projection, for the best match between their columns
+TABLE_RELATED: str = "TABLE_RELATED"
@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import defaultdict
+# Typing
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import edge_helper, graph_snapshot
+from ..search import redis_tools
+
+# Maximum number of table hops of a path between two related tables
+MAX_HOPS = int(os.environ.get("RELATED_MAX_HOPS", 5))
+# Version of the table-level projection, graphs projected with an older version are projected again once
+TABLE_RELATIONS_VERSION = 1
+
+# The best match between the columns of two tables: its weight and the ids of the matching columns
+Relation = Dict[str, Any]
+Hop = Tuple[str, str, Relation]
+
+
+class TableGraph:
+    """
+    The table-level projection of the graph at a given version, with tables as vertices and their best column match
+    as weighted edge. The breadth-first searches from every source table are kept for as long as the graph is.
+    """
+
+    def __init__(self, version: int, relations: List[Dict[str, Any]]):
+        self.version = version
+        self.adjacency: Dict[str, Dict[str, Relation]] = defaultdict(dict)
+        for relation in relations:
+            self.adjacency[relation["from_path"]][relation["to_path"]] = {
+                "weight": relation["weight"], "from_id": relation["from_id"], "to_id": relation["to_id"]}
+            self.adjacency[relation["to_path"]][relation["from_path"]] = {
+                "weight": relation["weight"], "from_id": relation["to_id"], "to_id": relation["from_id"]}
+        self._searches: Dict[Tuple[str, int], Dict[str, Tuple[Optional[str], float]]] = {}
+
+    def _search(self, source: str, max_hops: int) -> Dict[str, Tuple[Optional[str], float]]:
+        """
+        Gets the parent of every table within max_hops of the source on a shortest path, together with the total
+        weight of that path. Among the shortest paths to a table, the one with the highest total weight is kept.
+        """
+        key = (source, max_hops)
+        if key not in self._searches:
+            parents = {source: (None, 0.0)}
+            frontier = [source]
+            for _ in range(max_hops):
+                reached = {}
+                for table in frontier:
+                    total = parents[table][1]
+                    for neighbour, relation in self.adjacency.get(table, {}).items():
+                        if neighbour in parents:
+                            continue
+                        if neighbour not in reached or total + relation["weight"] > reached[neighbour][1]:
+                            reached[neighbour] = (table, total + relation["weight"])
+                if not reached:
+                    break
+                parents.update(reached)
+                frontier = sorted(reached)
+            self._searches[key] = parents
+        return self._searches[key]
+
+    def path(self, from_table: str, to_table: str, max_hops: int = MAX_HOPS) -> Optional[List[Hop]]:
+        """
+        Gets the hops of a shortest path between the two tables, or None if they are not related within max_hops.
+        """
+        parents = self._search(from_table, max_hops)
+        if from_table == to_table or to_table not in parents:
+            return None
+        hops = []
+        table = to_table
+        while parents[table][0] is not None:
+            parent = parents[table][0]
+            hops.append((parent, table, self.adjacency[parent][table]))
+            table = parent
+        return hops[::-1]
+
+
+_graph: Optional[TableGraph] = None
+_migrated = False
+_lock = threading.Lock()
+
+
+def _migrate_table_relations() -> None:
+    # Graphs that were built before the projection existed, or with an older one, are projected from their matches
+    global _migrated
+    if _migrated:
+        return
+    if redis_tools.get_table_relations_version() < TABLE_RELATIONS_VERSION:
+        edge_helper.rebuild_table_relations()
+        redis_tools.set_table_relations_version(TABLE_RELATIONS_VERSION)
+    _migrated = True
+
+
+def get_table_graph() -> TableGraph:
+    """
+    Gets the table-level projection of the current graph, which is only loaded again once the graph changed. With the
+    graph snapshot enabled, the projection is derived from the snapshot instead of the TABLE_RELATED relations.
+    """
+    global _graph
+    if graph_snapshot.ENABLED:
+        snapshot = graph_snapshot.get_snapshot()
+        if _graph is None or _graph.version != snapshot.version:
+            with _lock:
+                if _graph is None or _graph.version != snapshot.version:
+                    _graph = TableGraph(snapshot.version, snapshot.table_relations())
+        return _graph
+    version = redis_tools.get_graph_version()
+    if _graph is None or _graph.version != version:
+        with _lock:
+            _migrate_table_relations()
+            version = redis_tools.get_graph_version()
+            if _graph is None or _graph.version != version:
+                _graph = TableGraph(version, edge_helper.get_table_relations())
+    return _graph
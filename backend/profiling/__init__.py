@@ -1 +1 @@
-from . import valentine, pandas
+from . import valentine, pandas, minhash, sketches, approximate, streaming, schema_features
@@ -0,0 +1,168 @@
+import logging
+import os
+# Typing
+from typing import Any, Dict, Optional, Set
+
+import numpy as np
+import pandas as pd
+
+from .pandas import convert_to_python_types
+from .sketches import HyperLogLog, QuantileSketch
+
+HLL_PRECISION = int(os.environ.get("SKETCH_HLL_PRECISION", 14))
+QUANTILE_SKETCH_K = int(os.environ.get("SKETCH_QUANTILE_K", 128))
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def merge_dtypes(dtypes: Set[str]) -> str:
+    """
+    Gets the dtype that pandas would infer for a whole column, given the dtypes inferred for its chunks.
+    """
+    if len(dtypes) == 1:
+        return next(iter(dtypes))
+    if dtypes and all(dtype.startswith(("int", "float")) for dtype in dtypes):
+        return "float64"
+    return "object"
+
+
+def _running(current: Any, candidate: Any, pick) -> Any:
+    if candidate is None or pd.isna(candidate):
+        return current
+    return candidate if current is None else pick(current, candidate)
+
+
+class ApproximateColumnProfile:
+    """
+    Mergeable profile of a column that is fed chunk by chunk.
+
+    Row, null, min/max and string length statistics are exact running counters, the number of distinct values is
+    estimated with a HyperLogLog sketch and the quantiles of numeric columns with a quantile sketch.
+    """
+
+    def __init__(self, name: str, hll: Optional[HyperLogLog] = None, quantiles: Optional[QuantileSketch] = None,
+                 sketch_quantiles: bool = True, sketch_distinct: bool = True):
+        self.name = name
+        self.sketch_quantiles = sketch_quantiles
+        self.sketch_distinct = sketch_distinct
+        self.row_count = 0
+        self.null_count = 0
+        self.min = None
+        self.max = None
+        self.str_min = None
+        self.str_max = None
+        self.dtypes: Set[str] = set()
+        self.comparable = True
+        self.hll = hll or HyperLogLog(p=HLL_PRECISION)
+        self.quantiles = quantiles or QuantileSketch(k=QUANTILE_SKETCH_K)
+
+    def update(self, series: pd.Series) -> None:
+        null_mask = series.isna()
+        self.update_values(series[~null_mask], int(null_mask.sum()))
+
+    def update_values(self, values: pd.Series, null_count: int) -> None:
+        """
+        Updates the profile with the non-missing values of a chunk of the column and its number of missing values,
+        which are found once for all columns of the chunk by update_profiles.
+        """
+        self.dtypes.add(str(values.dtype))
+        self.null_count += null_count
+        self.row_count += len(values)
+        if len(values) == 0:
+            return
+
+        self._update_distinct(values.unique())
+        if self.sketch_quantiles and pd.api.types.is_numeric_dtype(values.dtype) \
+                and not pd.api.types.is_bool_dtype(values.dtype):
+            self.quantiles.update(values.to_numpy(dtype="float64"))
+        if pd.api.types.is_string_dtype(values.dtype):
+            try:
+                lengths = values.str.len()
+                self.str_min = _running(self.str_min, lengths.min(), min)
+                self.str_max = _running(self.str_max, lengths.max(), max)
+            except AttributeError:
+                # Object chunks without any strings have no string lengths
+                pass
+        self._update_range(values.min, values.max)
+
+    def _update_distinct(self, distinct: np.ndarray) -> None:
+        if self.sketch_distinct:
+            self.hll.update(pd.Series(distinct))
+
+    def merge(self, other: "ApproximateColumnProfile") -> None:
+        self.row_count += other.row_count
+        self.null_count += other.null_count
+        self.dtypes |= other.dtypes
+        self.str_min = _running(self.str_min, other.str_min, min)
+        self.str_max = _running(self.str_max, other.str_max, max)
+        self.hll.merge(other.hll)
+        self.quantiles.merge(other.quantiles)
+        self.comparable = self.comparable and other.comparable
+        self._update_range(lambda: other.min, lambda: other.max)
+
+    def _update_range(self, get_min, get_max) -> None:
+        if not self.comparable:
+            return
+        try:
+            self.min = _running(self.min, get_min(), min)
+            self.max = _running(self.max, get_max(), max)
+        except TypeError as e:
+            # Chunks of the same column can be parsed with incomparable types, e.g. numbers and strings
+            logging.warning(f"Failed to keep the range of column {self.name} because: {e}")
+            self.comparable = False
+
+    @property
+    def cardinality(self) -> int:
+        # Same as the exact profile, a missing value counts as a distinct value
+        return min(self.hll.count(), self.row_count) + (1 if self.null_count > 0 else 0)
+
+    def to_properties(self) -> Dict[str, Any]:
+        """
+        Gets the profile with the same keys as the exact profile, plus the quantiles, the serialized sketches and
+        whether the values of the column can be ordered, which is needed to merge the range of appended rows.
+        """
+        profile = {
+            "cardinality": self.cardinality,
+            "row_count": self.row_count,
+            "min": self.min if self.comparable and self.min is not None else '',
+            "max": self.max if self.comparable and self.max is not None else '',
+            "str_min": self.str_min if self.str_min is not None else '',
+            "str_max": self.str_max if self.str_max is not None else '',
+            "null_values": self.null_count,
+            "distinct": self.cardinality == self.row_count,
+            "uniqueness": self.cardinality / self.row_count if self.row_count else '',
+            "data_type": merge_dtypes(self.dtypes),
+            "quantiles": self.quantiles.quantiles(QUANTILES),
+            "approximate": True,
+            "comparable": self.comparable,
+            "hll_sketch": self.hll.serialize(),
+            "quantile_sketch": self.quantiles.serialize(),
+        }
+        return convert_to_python_types(profile)
+
+    @classmethod
+    def from_properties(cls, name: str, properties: Dict[str, Any]) -> "ApproximateColumnProfile":
+        """
+        Restores a profile from stored node properties, e.g. to merge in the profile of appended data.
+        """
+        column = cls(name, HyperLogLog.deserialize(properties["hll_sketch"]),
+                     QuantileSketch.deserialize(properties["quantile_sketch"]))
+        column.row_count = properties["row_count"]
+        column.null_count = properties["null_values"]
+        column.min = properties["min"] if properties["min"] != '' else None
+        column.max = properties["max"] if properties["max"] != '' else None
+        # Profiles stored without the flag only lack a range when the column had no values or incomparable ones
+        column.comparable = properties.get("comparable", column.min is not None or column.row_count == 0)
+        column.str_min = properties["str_min"] if properties["str_min"] != '' else None
+        column.str_max = properties["str_max"] if properties["str_max"] != '' else None
+        column.dtypes = {properties["data_type"]}
+        return column
+
+
+def update_profiles(profiles: Dict[str, ApproximateColumnProfile], chunk: pd.DataFrame) -> None:
+    """
+    Updates the profiles of the columns of a chunk, finding the missing values of all columns at once.
+    """
+    null_mask = chunk.isna()
+    null_counts = null_mask.sum()
+    for name, profile in profiles.items():
+        profile.update_values(chunk[name][~null_mask[name]], int(null_counts[name]))
@@ -2,12 +2,24 @@ import logging
 import os
 
 from backend.discovery import relation_types
-from backend.discovery.crud import create_relation, set_relation_properties
+from backend.discovery.relation_sink import RelationSink
 
-from typing import Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from itertools import product
+import heapq
+import numbers
+import pickle
+import tempfile
+
+from collections import defaultdict
+from contextlib import nullcontext
+from itertools import count, product
 from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
 from backend.search import io_tools
 
 
@@ -23,38 +35,299 @@ class Ref:
         return self.columns.__iter__()
 
 
+@dataclass(frozen=True)
+class ColumnValues:
+    """
+    The distinct non-null values of a column, sorted when the values are comparable with each other.
+    """
+    ref: Ref
+    dtype: str
+    values: np.ndarray
+    is_sorted: bool
+
+    @property
+    def cardinality(self) -> int:
+        return len(self.values)
+
+    @property
+    def min(self) -> Any:
+        return self.values[0]
+
+    @property
+    def max(self) -> Any:
+        return self.values[-1]
+
+
+def get_column_values(table_path: str, series: pd.Series) -> Optional[ColumnValues]:
+    """
+    Deduplicates and sorts the values of the given column, or returns None if the column has no values.
+    """
+    values = series.dropna().unique()
+    if len(values) == 0:
+        return None
+
+    try:
+        values = np.sort(values)
+        is_sorted = True
+    except TypeError:
+        # Object columns with mixed types can not be ordered
+        is_sorted = False
+
+    return ColumnValues(Ref(table_path, frozenset({series.name})), str(series.dtype), values, is_sorted)
+
+
+def may_be_included(A: ColumnValues, B: ColumnValues) -> bool:
+    """
+    Cheap necessary conditions for A ⊆ B: same dtype, at most as many distinct values and a contained value range.
+    """
+    if A.ref.table == B.ref.table or A.dtype != B.dtype or A.cardinality > B.cardinality:
+        return False
+    if A.is_sorted and B.is_sorted:
+        return B.min <= A.min and A.max <= B.max
+    return True
+
+
+def is_included(A: ColumnValues, B: ColumnValues) -> bool:
+    """
+    Checks whether all values of A are in B, using a binary search of the sorted values when possible.
+    """
+    if A.is_sorted and B.is_sorted:
+        positions = np.searchsorted(B.values, A.values)
+        positions[positions == B.cardinality] = B.cardinality - 1
+        return bool((B.values[positions] == A.values).all())
+    return set(A.values) <= set(B.values)
+
+
 def find_inclusion_dependencies(table_paths: Set[str]) -> None:
     """
     Finds unary INDs between the given tables.
     """
-    columns = {}
+    _add_inclusion_dependencies(get_inclusion_dependencies(table_paths))
+
+
+def get_inclusion_dependencies(table_paths: Set[str]) -> Dict[Ref, Set[Ref]]:
+    """
+    Gets the unary INDs between the given tables, as the referenced columns per dependent column.
+    """
+    # Group the columns by dtype, since only columns with equal dtypes can be included in each other
+    columns_by_dtype: Dict[str, List[ColumnValues]] = defaultdict(list)
     for path in table_paths:
         df = io_tools.get_df(path)
         for c in df:
-            ref = Ref(path, frozenset({c}))
-            columns[ref] = df[c].dropna()
-
-    # Start selecting suitable candidates for INDs
-    cands = {c: set() for c in columns}
-    for A, B in product(columns, repeat=2):
-        col_A = columns[A]
-        col_B = columns[B]
-
-        bl_same_table = A.table == B.table
-        bl_same_column = col_A is col_B
-        bl_different_dtypes = col_A.dtype != col_B.dtype
-        bl_empty = len(col_A) == 0
-        if any([bl_same_column, bl_different_dtypes, bl_same_table, bl_empty]):
-            continue
-
-        # Check if column fully contains other column
-        A_in_B = col_A.isin(col_B)
-        if A_in_B.all():
-            # logging.info(f"{A}-->{B}")
-            cands[A].add(B)
+            column = get_column_values(path, df[c])
+            if column is not None:
+                columns_by_dtype[column.dtype].append(column)
+
+    # Start selecting suitable candidates for INDs, and only validate the ones that survive the pruning
+    cands = defaultdict(set)
+    for columns in columns_by_dtype.values():
+        for A, B in product(columns, repeat=2):
+            if may_be_included(A, B) and is_included(A, B):
+                # logging.info(f"{A.ref}-->{B.ref}")
+                cands[A.ref].add(B.ref)
+
+    return cands
 
+
+def _add_inclusion_dependencies(cands: Dict[Ref, Set[Ref]], sink: Optional[RelationSink] = None) -> None:
     # Add the found unary INDs to Neo4J
-    inds = {c: s for c in cands for s in cands[c]}
-    for frm, to in inds.items():
-        create_relation(repr(frm), repr(to), relation_types.FOREIGN_KEY_IND)
-        set_relation_properties(repr(frm), repr(to), relation_types.FOREIGN_KEY_IND, from_id=repr(frm), to_id=repr(to))
+    with RelationSink() if sink is None else nullcontext(sink) as sink:
+        for frm in cands:
+            for to in cands[frm]:
+                sink.add(repr(frm), repr(to), relation_types.FOREIGN_KEY_IND, from_id=repr(frm), to_id=repr(to))
+
+
+# Number of values per column that the streaming merge keeps in memory at once
+STREAM_BLOCK_SIZE = int(os.environ.get("IND_STREAM_BLOCK_SIZE", 65536))
+
+
+@dataclass(frozen=True)
+class ColumnStream:
+    """
+    Sorted distinct values of a column that were spilled to disk, together with the statistics used for pruning.
+
+    Fixed width values are spilled as a single array that is memory-mapped, the values of object columns as
+    consecutive pickled blocks of their sort keys, so a single long value does not widen all others.
+    """
+    ref: Ref
+    dtype: str
+    file: Path
+    cardinality: int
+    min: Any
+    max: Any
+    is_sorted: bool = True
+
+
+def _is_array(stream: ColumnStream) -> bool:
+    return stream.file.suffix == ".npy"
+
+
+def _sort_key(value: Any) -> Tuple[int, str, Any]:
+    """
+    Gets a key that orders the values of object columns, also when they mix types, e.g. numbers and strings.
+
+    Numbers are ordered among each other, since equal numbers of different types are equal values, all other values
+    are ordered by type first. Keys are equal exactly when their values are.
+    """
+    if isinstance(value, numbers.Number):
+        return 0, "", value
+    return 1, type(value).__name__, value
+
+
+class _BlockReader:
+    """
+    Reads the blocks of a spilled column one at a time, without keeping the file open in between.
+    """
+
+    def __init__(self, stream: ColumnStream):
+        self.file = stream.file
+        self.values = np.load(stream.file, mmap_mode="r") if _is_array(stream) else None
+        # Position of the next block, in values for arrays and in bytes for pickled blocks
+        self.offset = 0
+        self.end = stream.cardinality if self.values is not None else stream.file.stat().st_size
+
+    def read(self) -> Optional[Any]:
+        """
+        Gets the next block, or None when the column is exhausted.
+        """
+        if self.offset >= self.end:
+            return None
+        if self.values is not None:
+            block = np.asarray(self.values[self.offset:self.offset + STREAM_BLOCK_SIZE])
+            self.offset += len(block)
+            return block
+        with open(self.file, "rb") as f:
+            f.seek(self.offset)
+            block = pickle.load(f)
+            self.offset = f.tell()
+        return block
+
+
+class _Cursor:
+    """
+    Iterates over the values of a spilled column, reading a single block at a time.
+    """
+
+    def __init__(self, stream: ColumnStream):
+        self.reader = _BlockReader(stream)
+        self.block = self._next_block()
+        self.position = 0
+
+    def _next_block(self):
+        block = self.reader.read()
+        return block if block is not None else []
+
+    def current(self) -> Any:
+        return self.block[self.position]
+
+    def advance(self) -> bool:
+        """
+        Moves to the next value, returns False when the column is exhausted.
+        """
+        self.position += 1
+        if self.position == len(self.block):
+            self.block = self._next_block()
+            self.position = 0
+        return len(self.block) > 0
+
+
+def _spill(column: ColumnValues, directory: Path, index: int) -> Optional[ColumnStream]:
+    """
+    Spills the sorted distinct values of a column, or returns None if its values can not be ordered.
+    """
+    values = column.values
+    if values.dtype != object:
+        if not column.is_sorted:
+            return None
+        file = directory / f"{index}.npy"
+        np.save(file, values, allow_pickle=False)
+        return ColumnStream(column.ref, column.dtype, file, len(values), values[0], values[-1])
+
+    # Object arrays can not be memory-mapped, and as fixed width unicode they would take the width of the longest value
+    try:
+        keys = sorted(map(_sort_key, values))
+    except TypeError:
+        # Values of the same type that can not be ordered, e.g. complex numbers
+        return None
+    file = directory / f"{index}.pkl"
+    with open(file, "wb") as f:
+        for start in range(0, len(keys), STREAM_BLOCK_SIZE):
+            pickle.dump(keys[start:start + STREAM_BLOCK_SIZE], f, protocol=pickle.HIGHEST_PROTOCOL)
+    return ColumnStream(column.ref, column.dtype, file, len(keys), keys[0], keys[-1])
+
+
+def _spider(streams: List[ColumnStream], refs: Dict[Ref, Set[Ref]]) -> None:
+    """
+    Narrows down the referenced candidates of every stream with a single merge over all sorted value streams.
+
+    For every distinct value, each column containing it keeps only the candidates that also contain it,
+    so the candidates that remain at the end include all values of the dependent column.
+    """
+    cursors = [_Cursor(stream) for stream in streams]
+    heap = [(cursor.current(), i) for i, cursor in enumerate(cursors)]
+    heapq.heapify(heap)
+
+    # Number of streams that still have candidates, the merge can stop early once there are none left
+    undecided = sum(1 for stream in streams if refs[stream.ref])
+    while heap and undecided > 0:
+        value = heap[0][0]
+        group = []
+        while heap and heap[0][0] == value:
+            _, i = heapq.heappop(heap)
+            group.append(i)
+            if cursors[i].advance():
+                heapq.heappush(heap, (cursors[i].current(), i))
+
+        containing = {streams[i].ref for i in group}
+        for i in group:
+            candidates = refs[streams[i].ref]
+            if candidates:
+                candidates &= containing
+                if not candidates:
+                    undecided -= 1
+
+
+def find_inclusion_dependencies_batch(table_paths: Set[str], focus: Optional[str] = None) -> None:
+    """
+    Finds unary INDs between all of the given tables at once, SPIDER-style.
+    """
+    _add_inclusion_dependencies(get_inclusion_dependencies_batch(table_paths, focus))
+
+
+def get_inclusion_dependencies_batch(table_paths: Set[str], focus: Optional[str] = None) -> Dict[Ref, Set[Ref]]:
+    """
+    Gets the unary INDs between all of the given tables at once, as the referenced columns per dependent column.
+
+    Every table is parsed once, after which the sorted distinct values of its columns are spilled to disk.
+    All candidates are then validated in a single merge over the value streams, so memory stays bounded by
+    the number of columns. If a focus table is given, only INDs involving that table are considered.
+    """
+    def considered(A: Ref, B: Ref) -> bool:
+        return focus is None or focus in (A.table, B.table)
+
+    cands = defaultdict(set)
+    with tempfile.TemporaryDirectory() as spill_dir:
+        spilled = count()
+        streams_by_dtype: Dict[str, List[ColumnStream]] = defaultdict(list)
+        for path in table_paths:
+            df = io_tools.get_df(path)
+            for c in df:
+                column = get_column_values(path, df[c])
+                if column is None:
+                    continue
+                stream = _spill(column, Path(spill_dir), next(spilled))
+                if stream is None:
+                    logging.warning(f"Skipping column {column.ref} in the IND search, its values can not be ordered")
+                    continue
+                streams_by_dtype[column.dtype].append(stream)
+            del df
+
+        for dtype, streams in streams_by_dtype.items():
+            refs = {A.ref: {B.ref for B in streams if considered(A.ref, B.ref) and may_be_included(A, B)}
+                    for A in streams}
+            _spider(streams, refs)
+            for ref, referenced in refs.items():
+                if referenced:
+                    cands[ref] |= referenced
+
+    return cands
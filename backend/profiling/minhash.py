@@ -0,0 +1,189 @@
+import logging
+import os
+import re
+import threading
+# Typing
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+from datasketch import LeanMinHash, MinHash, MinHashLSH
+
+from backend.search import redis_tools
+
+NUM_PERM = int(os.environ.get("LSH_NUM_PERM", 128))
+# Jaccard similarity above which two columns are considered candidates, 0 disables pruning altogether
+THRESHOLD = float(os.environ.get("LSH_THRESHOLD", 0.3))
+# Weight of false negatives versus false positives when tuning the bands, higher favours recall over fewer candidates
+FALSE_NEGATIVE_WEIGHT = float(os.environ.get("LSH_FALSE_NEGATIVE_WEIGHT", 0.5))
+
+# Signature kinds per column
+VALUES = "values"
+NAME = "name"
+
+# Signatures are only comparable when they were created with the same seed
+SEED = 1
+
+ColumnSignatures = Dict[str, Dict[str, List[int]]]
+
+
+def name_tokens(name: str) -> Set[str]:
+    """
+    Gets the lowercase word tokens (split on separators and camel case) and character trigrams of a column name.
+    """
+    words = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(name))
+    tokens = {token.lower() for token in re.split(r"[^0-9a-zA-Z]+", words) if token}
+    joined = "".join(sorted(tokens))
+    trigrams = {joined[i:i + 3] for i in range(len(joined) - 2)}
+    return tokens | trigrams
+
+
+def _minhash(values: Iterable[str]) -> MinHash:
+    m = MinHash(num_perm=NUM_PERM, seed=SEED)
+    m.update_batch([value.encode("utf8") for value in values])
+    return m
+
+
+def update_column_minhashes(minhashes: Dict[str, Dict[str, MinHash]], df: pd.DataFrame) -> None:
+    """
+    Updates the MinHashes of the distinct values and of the name tokens of every column with the given dataframe,
+    which can be one chunk of a larger table.
+
+    Empty sets are skipped, since their signatures would collide with every other empty set.
+    """
+    for column in df.columns:
+        if column not in minhashes:
+            minhashes[column] = {}
+            tokens = name_tokens(column)
+            if tokens:
+                minhashes[column][NAME] = _minhash(tokens)
+        distinct = df[column].dropna().unique()
+        if len(distinct) > 0:
+            if VALUES not in minhashes[column]:
+                minhashes[column][VALUES] = MinHash(num_perm=NUM_PERM, seed=SEED)
+            minhashes[column][VALUES].update_batch([str(value).encode("utf8") for value in distinct])
+
+
+def to_signatures(minhashes: Dict[str, Dict[str, MinHash]]) -> ColumnSignatures:
+    return {column: {kind: m.hashvalues.tolist() for kind, m in kinds.items()} for column, kinds in minhashes.items()}
+
+
+def from_signatures(signatures: ColumnSignatures) -> Dict[str, Dict[str, MinHash]]:
+    """
+    Restores the MinHashes of stored signatures, so they can be updated with the values of appended rows.
+    """
+    return {column: {kind: MinHash(seed=SEED, hashvalues=np.array(hashvalues, dtype=np.uint64))
+                     for kind, hashvalues in kinds.items()}
+            for column, kinds in signatures.items()}
+
+
+def get_column_signatures(df: pd.DataFrame) -> ColumnSignatures:
+    """
+    Gets the MinHash signatures of the distinct values and of the name tokens of every column in the dataframe.
+    """
+    minhashes = {}
+    update_column_minhashes(minhashes, df)
+    return to_signatures(minhashes)
+
+
+def _lsh() -> MinHashLSH:
+    return MinHashLSH(threshold=THRESHOLD, num_perm=NUM_PERM,
+                      weights=(1 - FALSE_NEGATIVE_WEIGHT, FALSE_NEGATIVE_WEIGHT))
+
+
+class CandidateIndex:
+    """
+    LSH indexes of the value and name signatures of the columns of the ingested tables.
+
+    The indexes are kept per process and only the signatures of tables that were added or changed since the last use
+    are loaded, a table changed when the hash of its stored fingerprint did.
+    """
+
+    def __init__(self):
+        self.indexes = {VALUES: _lsh(), NAME: _lsh()}
+        self.minhashes: Dict[str, List[Tuple[str, Tuple[str, str], LeanMinHash]]] = {}
+        self.versions: Dict[str, Optional[str]] = {}
+        self.unsketched: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def _remove(self, table_path: str) -> None:
+        for kind, key, _ in self.minhashes.pop(table_path, []):
+            self.indexes[kind].remove(key)
+        self.unsketched.discard(table_path)
+
+    def _insert(self, table_path: str) -> None:
+        signatures = redis_tools.get_signatures(table_path)
+        if signatures is None:
+            self.unsketched.add(table_path)
+            return
+        minhashes = []
+        for column, column_signatures in signatures.items():
+            for kind, hashvalues in column_signatures.items():
+                key = (table_path, column)
+                m = LeanMinHash(seed=SEED, hashvalues=np.array(hashvalues, dtype=np.uint64))
+                self.indexes[kind].insert(key, m)
+                minhashes.append((kind, key, m))
+        self.minhashes[table_path] = minhashes
+
+    def sync(self, table_paths: Set[str]) -> None:
+        """
+        Loads the signatures of the given tables that are not indexed yet or changed since they were.
+        """
+        versions = redis_tools.get_fingerprint_hashes(sorted(table_paths))
+        for table_path, version in versions.items():
+            # Tables without a stored fingerprint cannot be tracked, so their signatures are always loaded again
+            if table_path in self.versions and version is not None and self.versions[table_path] == version:
+                continue
+            self._remove(table_path)
+            self._insert(table_path)
+            self.versions[table_path] = version
+
+    def query(self, table_paths: Set[str], query_paths: Set[str]) -> Set[Tuple[str, str]]:
+        """
+        Gets the pairs between the query tables and the given tables with a column pair colliding in an index.
+        """
+        pairs = set()
+        for table_path in query_paths:
+            for kind, _, m in self.minhashes.get(table_path, []):
+                for other_path, _ in self.indexes[kind].query(m):
+                    if other_path != table_path and other_path in table_paths:
+                        pairs.add(tuple(sorted((table_path, other_path))))
+        return pairs
+
+
+_index = CandidateIndex()
+
+
+def candidate_table_pairs(table_paths: Iterable[str],
+                          query_paths: Optional[Iterable[str]] = None) -> Tuple[Set[Tuple[str, str]], Set[str]]:
+    """
+    Gets the pairs of tables that have at least one column pair colliding in the LSH index of value or name signatures.
+    Only the columns of the query tables are looked up, by default those of all given tables.
+
+    Also returns the tables without stored signatures, those can not be pruned.
+    """
+    table_paths = set(table_paths)
+    query_paths = table_paths if query_paths is None else set(query_paths)
+    with _index.lock:
+        _index.sync(table_paths)
+        return _index.query(table_paths, query_paths), _index.unsketched & table_paths
+
+
+def prune_pairs(pairs: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Filters the given table pairs down to the candidates from the LSH index, keeping their order.
+
+    Pairs with a table that has no stored signatures are always kept.
+    """
+    if THRESHOLD <= 0 or not pairs:
+        return pairs
+
+    # A star only needs the candidates of its center table
+    centers = set(pairs[0]).intersection(*pairs[1:])
+    query_paths = {next(iter(centers))} if centers else None
+    candidates, unsketched = candidate_table_pairs({table_path for pair in pairs for table_path in pair}, query_paths)
+    pruned = [(a, b) for a, b in pairs
+              if a in unsketched or b in unsketched or tuple(sorted((a, b))) in candidates]
+
+    logging.info(f"LSH kept {len(pruned)} of {len(pairs)} table pairs ({len(pruned) / len(pairs):.1%})")
+    return pruned
@@ -0,0 +1,83 @@
+import os
+from itertools import product
+# Typing
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .minhash import VALUES, ColumnSignatures, name_tokens
+
+# Weight of the name similarity versus the value similarity of two columns in the feature matcher
+NAME_WEIGHT = float(os.environ.get("VALENTINE_NAME_WEIGHT", 0.5))
+
+# Kinds of columns whose values can be compared with each other
+NUMERIC = "numeric"
+BOOLEAN = "boolean"
+STRING = "string"
+
+TableFeatures = Dict[str, Any]
+
+
+def type_signature(dtype: str) -> Dict[str, str]:
+    dtype = pd.api.types.pandas_dtype(dtype)
+    if pd.api.types.is_bool_dtype(dtype):
+        kind = BOOLEAN
+    elif pd.api.types.is_numeric_dtype(dtype):
+        kind = NUMERIC
+    else:
+        kind = STRING
+    return {"kind": kind, "dtype": str(dtype)}
+
+
+def get_table_features(dtypes: Dict[str, str]) -> TableFeatures:
+    """
+    Gets the features that matching needs from the dtypes of the columns of a table: the name tokens and type
+    signature of every column. The values are compared through the MinHash signatures stored at ingestion, so the
+    features stay small and no rows of the table are kept.
+    """
+    return {
+        "columns": {
+            column: {
+                "tokens": sorted(name_tokens(column)),
+                "type": type_signature(dtype),
+            }
+            for column, dtype in dtypes.items()
+        }
+    }
+
+
+def _jaccard(a: Set[Any], b: Set[Any]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _estimated_jaccard(a: Optional[List[int]], b: Optional[List[int]]) -> float:
+    # The fraction of equal MinHash values estimates the Jaccard similarity of the hashed sets
+    if not a or not b or len(a) != len(b):
+        return 0.0
+    return float(np.mean(np.array(a, dtype=np.uint64) == np.array(b, dtype=np.uint64)))
+
+
+def match_features(features1: TableFeatures, features2: TableFeatures, signatures1: ColumnSignatures,
+                   signatures2: ColumnSignatures) -> Dict[Tuple[Tuple[str, str], Tuple[str, str]], float]:
+    """
+    Matches the columns of two tables on their precomputed features, in the same format as the Valentine matchers.
+
+    The similarity of two columns is the weighted Jaccard similarity of their name tokens and of their distinct values,
+    as estimated from their value signatures, where values only count for columns of the same kind.
+    """
+    def prepare(features: TableFeatures, signatures: ColumnSignatures):
+        return [(column, set(f["tokens"]), f["type"]["kind"], signatures.get(column, {}).get(VALUES))
+                for column, f in features["columns"].items()]
+
+    matches = {}
+    for (column1, tokens1, kind1, values1), (column2, tokens2, kind2, values2) \
+            in product(prepare(features1, signatures1), prepare(features2, signatures2)):
+        similarity = NAME_WEIGHT * _jaccard(tokens1, tokens2)
+        if kind1 == kind2:
+            similarity += (1 - NAME_WEIGHT) * _estimated_jaccard(values1, values2)
+        if similarity > 0:
+            matches[(("table_1", column1), ("table_2", column2))] = similarity
+    return dict(sorted(matches.items(), key=lambda item: item[1], reverse=True))
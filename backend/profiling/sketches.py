@@ -0,0 +1,130 @@
+import base64
+import json
+# Typing
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+def hash_values(values: pd.Series) -> np.ndarray:
+    """
+    Hashes the given values to 64 bits, such that equal values hash equally regardless of the dtype of the chunk
+    they were parsed in (e.g. 1 in an int64 chunk and 1.0 in a float64 chunk).
+    """
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        values = values.astype("float64")
+    else:
+        values = values.astype(str)
+    return pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+
+
+def _leading_zeros(words: np.ndarray) -> np.ndarray:
+    """
+    Counts the leading zero bits of non-zero 64 bit words, vectorized by binary search over the bit positions.
+    """
+    counts = np.zeros(len(words), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        empty = words < (np.uint64(1) << np.uint64(64 - shift))
+        counts[empty] += shift
+        words = np.where(empty, words << np.uint64(shift), words)
+    return counts
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct count sketch with 2^p registers, mergeable by taking the register-wise maximum.
+    """
+
+    def __init__(self, p: int = 14, registers: Optional[np.ndarray] = None):
+        self.p = p
+        self.registers = registers if registers is not None else np.zeros(1 << p, dtype=np.uint8)
+
+    def update(self, values: pd.Series) -> None:
+        if len(values) == 0:
+            return
+        hashes = hash_values(values)
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        # The guard bit bounds the rank, so words are never zero
+        words = (hashes << np.uint64(self.p)) | (np.uint64(1) << np.uint64(self.p - 1))
+        np.maximum.at(self.registers, index, _leading_zeros(words) + 1)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def serialize(self) -> str:
+        return base64.b64encode(self.registers.tobytes()).decode("ascii")
+
+    @classmethod
+    def deserialize(cls, state: str) -> "HyperLogLog":
+        registers = np.frombuffer(base64.b64decode(state), dtype=np.uint8).copy()
+        return cls(p=int(np.log2(len(registers))), registers=registers)
+
+
+class QuantileSketch:
+    """
+    KLL-style quantile sketch: a stack of compactors holding at most k items each, where every item at level i
+    represents 2^i original values. Full compactors promote every other sorted item to the next level.
+    """
+
+    def __init__(self, k: int = 128, levels: Optional[List[np.ndarray]] = None):
+        self.k = k
+        self.levels = levels if levels is not None else []
+
+    def update(self, values: np.ndarray) -> None:
+        if len(values) == 0:
+            return
+        self._add(0, np.asarray(values, dtype=np.float64))
+        self._compress()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        for level, items in enumerate(other.levels):
+            self._add(level, items)
+        self._compress()
+
+    def quantiles(self, fractions: List[float]) -> List[float]:
+        if not self.levels or sum(len(items) for items in self.levels) == 0:
+            return []
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 2 ** level, dtype=np.float64)
+                                  for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind="mergesort")
+        cumulative = np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, np.asarray(fractions) * cumulative[-1])
+        return items[order][np.minimum(positions, len(items) - 1)].tolist()
+
+    def _add(self, level: int, items: np.ndarray) -> None:
+        while len(self.levels) <= level:
+            self.levels.append(np.empty(0, dtype=np.float64))
+        self.levels[level] = np.concatenate([self.levels[level], items])
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.k:
+                items = np.sort(items)
+                # An odd item stays behind, the random offset keeps the estimates unbiased
+                kept = items[len(items) - len(items) % 2:]
+                promoted = items[np.random.randint(2):len(items) - len(kept):2]
+                self.levels[level] = kept
+                self._add(level + 1, promoted)
+            level += 1
+
+    def serialize(self) -> str:
+        return json.dumps({"k": self.k, "levels": [items.tolist() for items in self.levels]})
+
+    @classmethod
+    def deserialize(cls, state: str) -> "QuantileSketch":
+        parsed = json.loads(state)
+        return cls(k=parsed["k"], levels=[np.asarray(items, dtype=np.float64) for items in parsed["levels"]])
@@ -0,0 +1,123 @@
+import logging
+import os
+# Typing
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .approximate import ApproximateColumnProfile, update_profiles
+
+# Memory budget in bytes for the distinct values that are kept to compute exact cardinalities of a single table
+MEMORY_LIMIT = int(os.environ.get("PROFILING_MEMORY_LIMIT", 1024 * 1024 * 1024))
+
+
+def _nbytes(values: np.ndarray) -> int:
+    return int(pd.Series(values).memory_usage(index=False, deep=True))
+
+
+class StreamingColumnProfile(ApproximateColumnProfile):
+    """
+    Mergeable profile of a column that is fed chunk by chunk, with an exact number of distinct values.
+
+    The distinct values of the chunks are kept and deduplicated in amortized batches. When they are released to stay
+    within the memory budget, the cardinality falls back to the HyperLogLog estimate of the approximate profile, which
+    is only sketched from then on, starting with the distinct values that were released.
+    """
+
+    def __init__(self, name: str, exact: bool = True, sketch_quantiles: bool = False):
+        super().__init__(name, sketch_quantiles=sketch_quantiles, sketch_distinct=not exact)
+        self.distinct: Optional[np.ndarray] = np.empty(0) if exact else None
+        self.distinct_bytes = 0
+        self._pending: List[np.ndarray] = []
+        self._pending_count = 0
+
+    @property
+    def exact(self) -> bool:
+        return self.distinct is not None
+
+    def _update_distinct(self, distinct: np.ndarray) -> None:
+        super()._update_distinct(distinct)
+
+        if self.exact:
+            chunk_distinct = np.asarray(distinct)
+            self._pending.append(chunk_distinct)
+            self._pending_count += len(chunk_distinct)
+            self.distinct_bytes += _nbytes(chunk_distinct)
+            # Deduplicate once the pending values outnumber the known distinct values, so every value is only
+            # deduplicated a logarithmic number of times
+            if self._pending_count > len(self.distinct):
+                self._consolidate()
+
+    def _consolidate(self) -> None:
+        if self._pending:
+            known = [self.distinct] if len(self.distinct) > 0 else []
+            self.distinct = pd.unique(np.concatenate(known + self._pending))
+            self.distinct_bytes = _nbytes(self.distinct)
+            self._pending = []
+            self._pending_count = 0
+
+    def release(self) -> None:
+        """
+        Releases the distinct values, from now on the cardinality is estimated.
+        """
+        logging.warning(f"Releasing the distinct values of column {self.name}, its cardinality will be estimated")
+        self._consolidate()
+        self.hll.update(pd.Series(self.distinct))
+        self.sketch_distinct = True
+        self.distinct = None
+        self.distinct_bytes = 0
+        self._pending = []
+        self._pending_count = 0
+
+    @property
+    def cardinality(self) -> int:
+        if not self.exact:
+            return super().cardinality
+        self._consolidate()
+        return len(self.distinct) + (1 if self.null_count > 0 else 0)
+
+    def to_properties(self) -> Dict[str, Any]:
+        """
+        Gets the profile with the same keys as the exact profile. Profiles with an estimated cardinality also
+        contain the approximate flag. The quantiles are only sketched on request, and the sketches are only kept
+        together with the comparable flag, since appended rows can only be merged into a profile with all of them.
+        """
+        properties = super().to_properties()
+        if not self.sketch_quantiles:
+            properties.pop("quantiles")
+            properties.pop("quantile_sketch")
+            properties.pop("hll_sketch")
+            properties.pop("comparable")
+        if self.exact:
+            properties.pop("approximate")
+            properties.pop("hll_sketch", None)
+            properties.pop("comparable", None)
+        return properties
+
+
+def get_profiles_streaming(chunks: Iterable[pd.DataFrame], approximate: bool = False,
+                           memory_limit: int = MEMORY_LIMIT) -> Dict[str, StreamingColumnProfile]:
+    """
+    Gets a mergeable profile per column name, reading the given dataframe chunks one at a time.
+
+    In exact mode, the distinct values of the columns are kept to compute exact cardinalities. Whenever these
+    exceed the memory limit, the columns with the most distinct values fall back to estimated cardinalities.
+    """
+    profiles: Dict[str, StreamingColumnProfile] = {}
+    for chunk in chunks:
+        for column_name in chunk.columns:
+            if column_name not in profiles:
+                profiles[column_name] = StreamingColumnProfile(column_name, exact=not approximate,
+                                                               sketch_quantiles=approximate)
+        update_profiles(profiles, chunk)
+
+        exact = [profile for profile in profiles.values() if profile.exact]
+        used = sum(profile.distinct_bytes for profile in exact)
+        for profile in sorted(exact, key=lambda p: p.distinct_bytes, reverse=True):
+            if used <= memory_limit:
+                break
+            used -= profile.distinct_bytes
+            profile.release()
+
+    return profiles
@@ -1,26 +1,120 @@
+import json
+import logging
 import os
-from typing import Dict, Any, Tuple
+from contextlib import nullcontext
+from typing import Dict, Any, Optional, Tuple
 
 import pandas as pd
 from valentine.algorithms import Coma
 
 from backend.discovery import relation_types
-from backend.discovery.crud import create_relation, set_relation_properties
-from backend.search import redis_tools
+from backend.discovery.relation_sink import RelationSink
+from backend.search import io_tools, redis_tools
 from valentine import valentine_match
 
+from .schema_features import NAME_WEIGHT, TableFeatures, get_table_features, match_features
+
 threshold = float(os.environ['VALENTINE_THRESHOLD'])
+# Either 'coma' to run COMA on the first rows of both tables, or 'features' to only compare their precomputed features
+MATCHER = os.environ.get('VALENTINE_MATCHER', 'coma')
+
+# Part of the cache key of pair results, so changing the matcher invalidates them
+if MATCHER == 'features':
+    MATCHER_CONFIG = {"algorithm": "SchemaFeatures", "name_weight": NAME_WEIGHT, "values": "minhash"}
+else:
+    MATCHER_CONFIG = {"algorithm": "Coma", "strategy": "COMA_OPT"}
 
 
 def match(df1: pd.DataFrame, df2: pd.DataFrame) -> Dict[Tuple[Any, str], Tuple[Any, str]]:
     return valentine_match(df1, df2, Coma(strategy="COMA_OPT"))
 
 
-def process_match(table1_path: str, table2_path: str, matches: Dict[Tuple[Any, str], Tuple[Any, str]]) -> None:
+def _cache_key(table1_path: str, table2_path: str, rows_to_use: int) -> Tuple[Optional[str], bool]:
+    """
+    Gets the cache key of the matches of a pair of tables, which is the same in both orders of the pair, and whether
+    the given order is the reverse of the order in which the matches are cached.
+    """
+    tables = [redis_tools.get_table(table1_path), redis_tools.get_table(table2_path)]
+    if any(table is None or "fingerprint" not in table for table in tables):
+        return None, False
+    hashes = [table["fingerprint"]["hash"] for table in tables]
+    swapped = (hashes[1], table2_path) < (hashes[0], table1_path)
+    return json.dumps({
+        "tables": sorted(hashes),
+        "rows": rows_to_use,
+        "matcher": MATCHER_CONFIG,
+    }, sort_keys=True), swapped
+
+
+def match_tables(table1_path: str, table2_path: str, rows_to_use: int, df1: Optional[pd.DataFrame] = None) -> None:
+    """
+    Matches the first rows of the two tables and adds the resulting relations.
+    """
+    process_match(table1_path, table2_path, get_matches(table1_path, table2_path, rows_to_use, df1))
+
+
+def get_matches(table1_path: str, table2_path: str, rows_to_use: int,
+                df1: Optional[pd.DataFrame] = None) -> Dict[Tuple[Any, str], Tuple[Any, str]]:
+    """
+    Matches the first rows of the two tables with COMA, or the columns of the two tables on the schema features and
+    value signatures stored at ingestion. The first rows of the first table can be given when they were already read,
+    e.g. to match a table against many others.
+
+    Matches are cached by the content of both tables, the number of rows and the matcher configuration,
+    so a pair that was matched before is replayed without running the matcher again.
+    """
+    cache_key, swapped = _cache_key(table1_path, table2_path, rows_to_use)
+    cached = redis_tools.get_valentine_matches(cache_key) if cache_key else None
+    if cached is not None:
+        logging.info(f'Replaying cached matches of {table1_path}, {table2_path}')
+        if swapped:
+            cached = [[col_to, col_from, similarity] for col_from, col_to, similarity in cached]
+        matches = {((None, col_from), (None, col_to)): similarity for col_from, col_to, similarity in cached}
+    else:
+        if MATCHER == 'features':
+            matches = match_features(_get_features(table1_path), _get_features(table2_path),
+                                     redis_tools.get_signatures(table1_path) or {},
+                                     redis_tools.get_signatures(table2_path) or {})
+        else:
+            if df1 is None:
+                df1 = io_tools.get_df(table1_path, rows=rows_to_use)
+            matches = match(df1.copy(deep=False), io_tools.get_df(table2_path, rows=rows_to_use))
+        if cache_key:
+            # The matches are cached in the order of the key, so they can be replayed in either order of the pair
+            redis_tools.save_valentine_matches(cache_key, [table1_path, table2_path],
+                                               [[col_to, col_from, float(similarity)] if swapped
+                                                else [col_from, col_to, float(similarity)]
+                                                for ((_, col_from), (_, col_to)), similarity in matches.items()])
+    return matches
+
+
+def _get_features(table_path: str) -> TableFeatures:
+    """
+    Gets the features stored at ingestion, or extracts them when they are missing. Features that were stored
+    together with the first rows of the table are replaced, so those rows do not stay in Redis.
+    """
+    features = redis_tools.get_schema_features(table_path)
+    if features is None or "rows_to_use" in features:
+        table = redis_tools.get_table(table_path)
+        if table and table.get("dtypes"):
+            dtypes = table["dtypes"]
+        else:
+            dtypes = io_tools.get_df(table_path).dtypes.astype(str).to_dict()
+        features = get_table_features(dtypes)
+        if table:
+            redis_tools.save_schema_features(table_path, features)
+    return features
+
+
+def process_match(table1_path: str, table2_path: str, matches: Dict[Tuple[Any, str], Tuple[Any, str]],
+                  sink: Optional[RelationSink] = None) -> None:
+    """
+    Adds the matches above the threshold as relations, to the given sink if any, otherwise to a sink of its own.
+    """
     node_ids_t1 = redis_tools.get_node_ids(table1_path)
     node_ids_t2 = redis_tools.get_node_ids(table2_path)
-    for ((_, col_from), (_, col_to)), similarity in matches.items():
-        if similarity > threshold:
-            create_relation(node_ids_t1[col_from], node_ids_t2[col_to], relation_types.MATCH)
-            set_relation_properties(node_ids_t1[col_from], node_ids_t2[col_to], relation_types.MATCH, coma=similarity,
-                                    from_id=node_ids_t1[col_from], to_id=node_ids_t2[col_to])
+    with RelationSink() if sink is None else nullcontext(sink) as sink:
+        for ((_, col_from), (_, col_to)), similarity in matches.items():
+            if similarity > threshold:
+                sink.add(node_ids_t1[col_from], node_ids_t2[col_to], relation_types.MATCH, coma=similarity,
+                         from_id=node_ids_t1[col_from], to_id=node_ids_t2[col_to])
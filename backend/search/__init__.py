@@ -1 +1 @@
-from . import redis_tools, mongo_tools, io_tools
+from . import redis_tools, mongo_tools, io_tools, df_cache
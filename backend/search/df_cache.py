@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+# Typing
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import pandas as pd
+
+# Key format: table path, modification time (ns), file size, digest of the read options, row limit
+CacheKey = Tuple[str, int, int, str, Optional[int]]
+
+
+class DataFrameCache:
+    """
+    Process-level cache of parsed tables with a memory-bounded LRU tier and an optional, size-bounded on-disk Parquet
+    tier.
+
+    Entries are keyed by the table path, the modification time and size of the file, the options it is read with
+    (its dialect and dtypes) and the row limit, so a table that changes on disk or is read differently is never served
+    from a stale entry.
+    """
+
+    def __init__(self, max_bytes: int, disk_path: Optional[Path] = None, max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.max_disk_bytes = max_disk_bytes
+        self.size = 0
+        self._entries: "OrderedDict[CacheKey, Tuple[pd.DataFrame, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.disk_path is not None:
+            self.disk_path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, path: Path, table_path: str, rows: Optional[int], options: Dict[str, Any],
+            load: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Gets the parsed table for the given path read with the given options, only calling 'load' when no tier has
+        the table.
+
+        The returned dataframe is a shallow copy, so callers may add or drop columns without affecting the cache.
+        """
+        stat = path.stat()
+        options_digest = hashlib.sha256(str.encode(json.dumps(options, sort_keys=True, default=str))).hexdigest()[:16]
+        key = (table_path, stat.st_mtime_ns, stat.st_size, options_digest, rows)
+
+        df = self._get_memory(key)
+        if df is None:
+            df = self._get_disk(key)
+            if df is None:
+                df = load()
+                self._put_disk(key, df)
+            self._put_memory(key, df)
+
+        return df.copy(deep=False)
+
+    def clear(self, disk: bool = False) -> None:
+        """
+        Clears the memory tier of the cache, and the snapshots of the disk tier if asked to.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+        if disk and self.disk_path is not None:
+            for snapshot in self.disk_path.glob("*.parquet"):
+                _unlink(snapshot)
+
+    def _get_memory(self, key: CacheKey) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+
+            # A limited number of rows can be served from a cached full table
+            full_key = key[:4] + (None,)
+            entry = self._entries.get(full_key)
+            if entry is not None:
+                self._entries.move_to_end(full_key)
+                return entry[0].head(key[4])
+        return None
+
+    def _put_memory(self, key: CacheKey, df: pd.DataFrame) -> None:
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (df, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.size -= evicted_bytes
+
+    def _snapshot_path(self, key: CacheKey) -> Path:
+        # The name groups the snapshots of a table and of a version of its file and read options, so stale versions can
+        # be found
+        table_digest = hashlib.sha256(str.encode(key[0])).hexdigest()
+        version_digest = hashlib.sha256(str.encode(repr(key[1:4]))).hexdigest()[:16]
+        return self.disk_path / f"{table_digest}-{version_digest}-{key[4]}.parquet"
+
+    def _get_disk(self, key: CacheKey) -> Optional[pd.DataFrame]:
+        if self.disk_path is None:
+            return None
+
+        snapshot = self._snapshot_path(key)
+        if not snapshot.exists():
+            return None
+
+        try:
+            df = pd.read_parquet(snapshot)
+            # The modification time orders the snapshots for eviction, so reading one marks it as recently used
+            os.utime(snapshot)
+            return df
+        except FileNotFoundError:
+            # Evicted by another worker in the meantime
+            return None
+        except Exception as e:
+            logging.warning(f"Could not read snapshot of table {key[0]} because: {e}")
+            return None
+
+    def _put_disk(self, key: CacheKey, df: pd.DataFrame) -> None:
+        if self.disk_path is None:
+            return
+
+        snapshot = self._snapshot_path(key)
+        # Write to a temporary file first, so other workers never read a partially written snapshot
+        tmp_snapshot = snapshot.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            df.to_parquet(tmp_snapshot)
+            os.replace(tmp_snapshot, snapshot)
+        except Exception as e:
+            # Columns with mixed object types cannot be converted to Arrow, those tables stay memory-only
+            logging.warning(f"Could not write snapshot of table {key[0]} because: {e}")
+            if tmp_snapshot.exists():
+                tmp_snapshot.unlink()
+            return
+
+        self._remove_stale_snapshots(snapshot)
+        self._evict_disk()
+
+    def _remove_stale_snapshots(self, snapshot: Path) -> None:
+        # Snapshots of earlier versions of the same table, or read with its earlier options, are not served anymore
+        table_digest, version_digest, _ = snapshot.stem.split("-")
+        for other in self.disk_path.glob(f"{table_digest}-*.parquet"):
+            if other.stem.split("-")[1] != version_digest:
+                _unlink(other)
+
+    def _evict_disk(self) -> None:
+        if self.max_disk_bytes <= 0:
+            return
+
+        snapshots = []
+        for snapshot in self.disk_path.glob("*.parquet"):
+            try:
+                stat = snapshot.stat()
+            except FileNotFoundError:
+                continue
+            snapshots.append((stat.st_mtime_ns, stat.st_size, snapshot))
+
+        # Least recently used first
+        snapshots.sort()
+        disk_size = sum(size for _, size, _ in snapshots)
+        for _, size, snapshot in snapshots:
+            if disk_size <= self.max_disk_bytes:
+                break
+            _unlink(snapshot)
+            disk_size -= size
+
+
+def _unlink(snapshot: Path) -> None:
+    try:
+        snapshot.unlink()
+    except FileNotFoundError:
+        # Other workers share the disk tier and may have removed it already
+        pass
+
+
+df_cache: DataFrameCache = None
+
+
+def get_cache() -> DataFrameCache:
+    global df_cache
+
+    if df_cache is None:
+        disk_path = os.environ.get("DF_CACHE_DISK_PATH")
+        df_cache = DataFrameCache(
+            int(os.environ.get("DF_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+            Path(disk_path) if disk_path else None,
+            int(os.environ.get("DF_CACHE_DISK_MAX_BYTES", 8 * 1024 * 1024 * 1024))
+        )
+    return df_cache
@@ -1,3 +1,8 @@
+import codecs
+import csv
+import hashlib
+import logging
+
 import dask.dataframe as dd
 import pandas as pd
 import os
@@ -5,7 +10,17 @@ import os
 from pathlib import Path
 
 # Typing
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional
+
+from . import redis_tools
+from .df_cache import get_cache
+
+# Amount of bytes read from the start of a file to detect its dialect
+DIALECT_SAMPLE_SIZE = 64 * 1024
+CANDIDATE_ENCODINGS = ["utf-8-sig", "latin-1"]
+CANDIDATE_DELIMITERS = ",;\t|"
+# Block size used when hashing table contents
+HASH_BLOCK_SIZE = 1024 * 1024
 
 
 def root_path() -> Path:
@@ -40,14 +55,196 @@ def get_table_path_from_asset_id(asset_id: str) -> str:
     return ""
 
 
-def get_df(table_path: str, rows=None) -> pd.DataFrame:
+def get_fingerprint(table_path: str, prefix_size: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Gets the size, modification time and a content hash of the table at the given table_path.
+
+    If a prefix size is given, the content hash of that many first bytes is computed along the way, it is returned
+    but not part of the fingerprint itself.
+    """
+    path = root_path() / table_path
+    stat = path.stat()
+    content_hash = hashlib.blake2b(digest_size=16)
+    prefix_hash = None
+    read = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            if prefix_size is not None and prefix_hash is None and read + len(block) >= prefix_size:
+                content_hash.update(block[:prefix_size - read])
+                prefix_hash = content_hash.hexdigest()
+                block = block[prefix_size - read:]
+            content_hash.update(block)
+            read += len(block)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash.hexdigest()}
+    if prefix_size is not None:
+        fingerprint["prefix_hash"] = prefix_hash
+    return fingerprint
+
+
+def get_appended_offset(table_path: str, stored: Dict[str, Any], fingerprint: Dict[str, Any]) -> Optional[int]:
+    """
+    Gets the offset from which rows were appended to the table since it was ingested with the stored fingerprint,
+    or None if the table changed in any other way. The given fingerprint should have the prefix hash of the stored size.
+    """
+    offset = stored["size"]
+    if offset <= 0 or fingerprint["size"] <= offset or fingerprint.get("prefix_hash") != stored["hash"]:
+        return None
+    # Appended rows only start at the offset if the ingested content ended with a complete line
+    with open(root_path() / table_path, "rb") as f:
+        f.seek(offset - 1)
+        if f.read(1) != b"\n":
+            return None
+    return offset
+
+
+def needs_ingestion(table_path: str) -> bool:
+    """
+    Checks whether the table at the given table_path is new or has changed since it was ingested.
+
+    Tables with an unchanged size and modification time are skipped without reading them. Otherwise the content hash
+    decides, and the stored fingerprint is refreshed when only the modification time changed. Tables that were
+    ingested without a fingerprint are assumed unchanged, and their current fingerprint is stored from now on.
+    """
+    table = redis_tools.get_table(table_path)
+    if table is None:
+        return True
+
+    stored = table.get("fingerprint")
+    if stored is None:
+        # Ingested before fingerprints were kept, so an upgrade does not re-profile the whole catalog
+        redis_tools.set_fingerprint(table_path, get_fingerprint(table_path))
+        return False
+
+    stat = (root_path() / table_path).stat()
+    if stat.st_size == stored["size"] and stat.st_mtime_ns == stored["mtime_ns"]:
+        return False
+
+    fingerprint = get_fingerprint(table_path)
+    if fingerprint["hash"] != stored["hash"]:
+        return True
+
+    redis_tools.set_fingerprint(table_path, fingerprint)
+    return False
+
+
+def sniff_dialect(table_path: str) -> Dict[str, str]:
+    """
+    Detects the encoding, separator, quote and escape characters of the table at the given table_path.
+
+    Only the first DIALECT_SAMPLE_SIZE bytes of the file are inspected.
+    """
+    path = root_path() / table_path
+    with open(path, "rb") as f:
+        raw_sample = f.read(DIALECT_SAMPLE_SIZE)
+
+    encoding = CANDIDATE_ENCODINGS[-1]
+    for candidate in CANDIDATE_ENCODINGS:
+        try:
+            # Incremental decoding, since the sample may end halfway a multi-byte character
+            codecs.getincrementaldecoder(candidate)().decode(raw_sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        encoding = candidate
+        break
+    sample = raw_sample.decode(encoding, errors="ignore")
+
+    dialect = {"sep": ",", "quotechar": '"', "escapechar": "\\", "encoding": encoding}
+    try:
+        sniffed = csv.Sniffer().sniff(sample, delimiters=CANDIDATE_DELIMITERS)
+        dialect["sep"] = sniffed.delimiter
+        dialect["quotechar"] = sniffed.quotechar or '"'
+        dialect["escapechar"] = sniffed.escapechar or "\\"
+    except csv.Error:
+        logging.warning(f"Could not sniff the dialect of table {table_path}, assuming default CSV settings")
+
+    return dialect
+
+
+def get_dtypes(df: pd.DataFrame) -> Dict[str, str]:
+    """
+    Gets the dtypes of the given dataframe in a form that can be stored and passed back to 'read_csv'.
+    """
+    return {str(column): str(dtype) for column, dtype in df.dtypes.items()}
+
+
+def get_df(table_path: str, rows=None, dialect: Optional[Dict[str, str]] = None,
+           dtypes: Optional[Dict[str, str]] = None) -> pd.DataFrame:
     """
     Gets a pandas dataframe from the given table_path.
 
     The amount of rows can be limited with the 'rows' keyword.
+    The dialect and dtypes are taken from the table metadata when they are not given, and the dialect is sniffed
+    if the table was not ingested yet.
+    Parsed tables are cached per process (and optionally on disk), see 'df_cache'.
     """
     path = root_path() / table_path
+    options = _read_options(table_path, dialect, dtypes)
+    return get_cache().get(path, table_path, rows, options, lambda: _parse_csv(table_path, rows, options))
+
+
+def _read_options(table_path: str, dialect: Optional[Dict[str, str]],
+                  dtypes: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    if dialect is None:
+        table = redis_tools.get_table(table_path)
+        if table and table.get("dialect"):
+            dialect = table["dialect"]
+            dtypes = dtypes or table.get("dtypes")
+        else:
+            dialect = sniff_dialect(table_path)
 
+    return dict(dialect, dtype=dtypes)
+
+
+def _read_csv(table_path: str, rows=None, dialect: Optional[Dict[str, str]] = None,
+              dtypes: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    return _parse_csv(table_path, rows, _read_options(table_path, dialect, dtypes))
+
+
+def _parse_csv(table_path: str, rows: Optional[int], options: Dict[str, Any]) -> pd.DataFrame:
+    path = root_path() / table_path
+    try:
+        df = pd.read_csv(
+            path,
+            header=0,
+            engine="c",
+            nrows=rows,
+            on_bad_lines='skip',
+            **options
+        )
+    except (pd.errors.ParserError, ValueError, UnicodeDecodeError) as e:
+        logging.warning(f"Fast parsing of table {table_path} failed, falling back to sniffing parser: {e}")
+        df = read_csv_sniffing(path, rows)
+
+    return df
+
+
+def iter_df_chunks(table_path: str, chunksize: int, dialect: Optional[Dict[str, str]] = None,
+                   dtypes: Optional[Dict[str, str]] = None, offset: int = 0) -> Iterator[pd.DataFrame]:
+    """
+    Iterates over the table at the given table_path in pandas dataframes of at most 'chunksize' rows.
+
+    Chunks are not cached, so only a single chunk is kept in memory at a time. A byte offset at the start of a line
+    skips the rows before it, the columns are still named after the header.
+    """
+    path = root_path() / table_path
+    options = _read_options(table_path, dialect, dtypes)
+    if offset == 0:
+        with pd.read_csv(path, header=0, engine="c", chunksize=chunksize, on_bad_lines='skip', **options) as reader:
+            yield from reader
+        return
+
+    columns = pd.read_csv(path, header=0, engine="c", nrows=0, **options).columns
+    with open(path, "rb") as f:
+        f.seek(offset)
+        with pd.read_csv(f, header=None, names=columns, engine="c", chunksize=chunksize, on_bad_lines='skip',
+                         **options) as reader:
+            yield from reader
+
+
+def read_csv_sniffing(path: Path, rows=None) -> pd.DataFrame:
+    """
+    Parses the CSV at the given path with the (slow) python engine, sniffing the separator while parsing.
+    """
     df = pd.read_csv(
         path,
         header=0,
@@ -68,17 +265,16 @@ def get_ddf(table_path: str) -> dd.DataFrame:
     Gets a dask dataframe from the given table_path.
     """
     path = root_path() / table_path
+    options = _read_options(table_path, None, None)
 
     ddf = dd.read_csv(
         path,
-        sample_rows=1000,  # Sample 1000 rows to auto-determine dtypes
+        sample_rows=1000,  # Sample 1000 rows to auto-determine dtypes, unless they are known from ingestion
         blocksize=25e6,  # 25MB per block
         header=0,
-        engine="python",
-        encoding="utf8",
-        quotechar='"',
-        escapechar='\\',
+        engine="c",
         # on_bad_lines='warn', # For some reason Dask doesn't like this keyword parameter all of a sudden, even though it is supported!
+        **options
     )
 
     return ddf
@@ -1,10 +1,11 @@
 import logging
 import json
 import hashlib
+import os
 
 from ast import literal_eval
 # Typing
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 # Redis
 from redis.commands.json.path import Path
@@ -14,6 +15,10 @@ from ..clients import redis
 from ..utility.typing import Table
 
 
+# Seconds after which cached Valentine matches expire, so the matches of tables that changed or are gone do not pile up
+VALENTINE_CACHE_TTL = int(os.environ.get("VALENTINE_CACHE_TTL", 7 * 24 * 3600))
+
+
 def _deterministic_hash(string: str) -> str:
     return hashlib.sha256(str.encode(string)).hexdigest()
 
@@ -48,9 +53,32 @@ def get_celery_task(task_id: str) -> Optional[tuple]:
     return literal_eval(first["task"]["task_tuple"]) if first else None
 
 
-def add_table(table_name: str, table_path: str, column_count: int, nodes: Dict[str, str]) -> None:
+def save_celery_fan_out(task_id: str, result_tuples: List[tuple]) -> None:
+    """
+    Saves the result tuples of the subtasks that the task with the given task_id fanned out to.
+    """
+    redis.get_client().json().set(
+        f"fan_out:{_deterministic_hash(task_id)}",
+        Path.root_path(),
+        [str(result_tuple) for result_tuple in result_tuples]
+    )
+
+
+def get_celery_fan_out(task_id: str) -> List[tuple]:
     """
-    Adds a table with some useful metadata to the database.
+    Gets the result tuples of the subtasks that the task with the given task_id fanned out to, if any.
+    """
+    res = redis.get_client().json().get(f"fan_out:{_deterministic_hash(task_id)}")
+    return [literal_eval(result_tuple) for result_tuple in res] if res else []
+
+
+def add_table(table_name: str, table_path: str, column_count: int, nodes: Dict[str, str], dialect: Dict[str, str],
+              dtypes: Dict[str, str], fingerprint: Dict[str, Any]) -> None:
+    """
+    Adds a table with some useful metadata to the database, replacing the metadata of an earlier ingestion.
+
+    The dialect and dtypes are stored so that later reads of the table can skip sniffing and type inference,
+    and the fingerprint is used to detect whether the table changed since.
     """
     table_path_hash = _deterministic_hash(table_path)
     redis.get_client().json().set(
@@ -62,12 +90,187 @@ def add_table(table_name: str, table_path: str, column_count: int, nodes: Dict[s
                 "path": table_path,
                 "name": table_name,
                 "column_count": column_count,
-                "nodes": nodes
+                "nodes": nodes,
+                "dialect": dialect,
+                "dtypes": dtypes,
+                "fingerprint": fingerprint
             }
         }
     )
 
 
+def get_fingerprint_hashes(table_paths: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Gets the content hash of the stored fingerprint of each of the tables at the given paths, or None if it has none.
+    """
+    if not table_paths:
+        return {}
+    keys = [f"table:{_deterministic_hash(table_path)}" for table_path in table_paths]
+    hashes = redis.get_client().json().mget(keys, "$.table.fingerprint.hash")
+    return {table_path: found[0] if found else None for table_path, found in zip(table_paths, hashes)}
+
+
+def save_signatures(table_path: str, signatures: Dict[str, Dict[str, List[int]]]) -> None:
+    """
+    Saves the MinHash signatures of the columns of the table at the given path.
+    """
+    redis.get_client().json().set(f"signatures:{_deterministic_hash(table_path)}", Path.root_path(), signatures)
+
+
+def get_signatures(table_path: str) -> Optional[Dict[str, Dict[str, List[int]]]]:
+    """
+    Gets the MinHash signatures of the columns of the table at the given path, or None if there are none.
+    """
+    return redis.get_client().json().get(f"signatures:{_deterministic_hash(table_path)}")
+
+
+def save_schema_features(table_path: str, features: Dict[str, Any]) -> None:
+    """
+    Saves the schema features that Valentine matches the table at the given path on.
+    """
+    redis.get_client().json().set(f"features:{_deterministic_hash(table_path)}", Path.root_path(), features)
+
+
+def get_schema_features(table_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Gets the schema features of the table at the given path, or None if there are none.
+    """
+    return redis.get_client().json().get(f"features:{_deterministic_hash(table_path)}")
+
+
+def save_valentine_matches(cache_key: str, table_paths: List[str], matches: List[list]) -> None:
+    """
+    Saves the Valentine matches of a table pair as [column_from, column_to, similarity] triples, for at most
+    VALENTINE_CACHE_TTL seconds. The key is also registered with both tables, so it can be removed once one changes.
+    """
+    client = redis.get_client()
+    key = f"valentine:{_deterministic_hash(cache_key)}"
+    client.json().set(key, Path.root_path(), matches)
+    pipeline = client.pipeline()
+    pipeline.expire(key, VALENTINE_CACHE_TTL)
+    for table_path in table_paths:
+        table_keys = f"valentine_keys:{_deterministic_hash(table_path)}"
+        pipeline.sadd(table_keys, key)
+        pipeline.expire(table_keys, VALENTINE_CACHE_TTL)
+    pipeline.execute()
+
+
+def delete_valentine_matches(table_path: str) -> None:
+    """
+    Deletes the cached Valentine matches of all pairs with the table at the given path.
+    """
+    client = redis.get_client()
+    table_keys = f"valentine_keys:{_deterministic_hash(table_path)}"
+    client.delete(*client.smembers(table_keys), table_keys)
+
+
+def get_valentine_matches(cache_key: str) -> Optional[List[list]]:
+    """
+    Gets the Valentine matches of a table pair saved under the given cache_key, if any.
+    """
+    return redis.get_client().json().get(f"valentine:{_deterministic_hash(cache_key)}")
+
+
+def acquire_lease(name: str, owner: str, ttl: int) -> bool:
+    """
+    Acquires the lease with the given name for the given owner, unless another owner holds it.
+
+    Leases expire after ttl seconds, so work whose owner died is picked up again by later runs.
+    """
+    return bool(redis.get_client().set(f"lease:{_deterministic_hash(name)}", owner, nx=True, ex=ttl))
+
+
+def get_lease_owner(name: str) -> Optional[str]:
+    """
+    Gets the owner of the lease with the given name, or None if the lease is not held.
+    """
+    owner = redis.get_client().get(f"lease:{_deterministic_hash(name)}")
+    return owner.decode() if owner else None
+
+
+# Deletes the lease only if it is still held by the owner, so a lease that expired and was acquired again is kept
+_RELEASE_LEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+def release_lease(name: str, owner: Optional[str] = None) -> None:
+    """
+    Releases the lease with the given name, only if it is held by the given owner when one is given.
+    """
+    key = f"lease:{_deterministic_hash(name)}"
+    if owner is None:
+        redis.get_client().delete(key)
+    else:
+        redis.get_client().eval(_RELEASE_LEASE_SCRIPT, 1, key, owner)
+
+
+# Number of graph changes that are logged, readers that fell further behind reload the whole graph
+GRAPH_CHANGES_KEPT = 1000
+
+# Increments the version and logs the changed tables under it atomically, so the log is ordered by version
+_BUMP_GRAPH_VERSION_SCRIPT = """
+local version = redis.call('incr', KEYS[1])
+redis.call('rpush', KEYS[2], '{"version": ' .. version .. ', "tables": ' .. ARGV[1] .. '}')
+redis.call('ltrim', KEYS[2], -tonumber(ARGV[2]), -1)
+return version
+"""
+
+
+def bump_graph_version(table_paths: Optional[List[str]] = None) -> int:
+    """
+    Marks that the graph changed, so that everything derived from it is refreshed. Returns the new version.
+
+    The nodes and relations of the given tables are the ones that changed, None means that anything may have changed.
+    """
+    return redis.get_client().eval(_BUMP_GRAPH_VERSION_SCRIPT, 2, "graph_version", "graph_changes",
+                                   json.dumps(sorted(set(table_paths)) if table_paths is not None else None),
+                                   GRAPH_CHANGES_KEPT)
+
+
+def get_graph_changes(since: int) -> Optional[List[str]]:
+    """
+    Gets the tables whose nodes or relations changed after the given version of the graph,
+    or None if that is unknown because anything may have changed or the changes are no longer logged.
+    """
+    changes = [json.loads(change) for change in redis.get_client().lrange("graph_changes", 0, -1)]
+    if not changes or changes[0]["version"] > since + 1:
+        return [] if get_graph_version() == since else None
+
+    tables = set()
+    for change in changes:
+        if change["version"] > since:
+            if change["tables"] is None:
+                return None
+            tables.update(change["tables"])
+    return sorted(tables)
+
+
+def get_graph_version() -> int:
+    """
+    Gets the version of the graph, which changes whenever nodes or relations are added or deleted.
+    """
+    version = redis.get_client().get("graph_version")
+    return int(version) if version else 0
+
+
+def get_table_relations_version() -> int:
+    """
+    Gets the version of the table-level projection that the relations in the graph were last projected with.
+    """
+    version = redis.get_client().get("table_relations_version")
+    return int(version) if version else 0
+
+
+def set_table_relations_version(version: int) -> None:
+    redis.get_client().set("table_relations_version", version)
+
+
+def set_fingerprint(table_path: str, fingerprint: Dict[str, Any]) -> None:
+    """
+    Updates the fingerprint of an ingested table.
+    """
+    redis.get_client().json().set(f"table:{_deterministic_hash(table_path)}", "$.table.fingerprint", fingerprint)
+
+
 def list_tables() -> List[Table]:
     """
     Lists all tables that have metadata (meaning they were ingested).
@@ -113,4 +316,15 @@ def purge() -> None:
     """
     redis.drop_index("table")
     redis.drop_index("task")
+    _delete_keys("fan_out:*")
+    _delete_keys("signatures:*")
+    _delete_keys("valentine:*")
+    _delete_keys("valentine_keys:*")
+    _delete_keys("features:*")
     redis.initialize()
+
+
+def _delete_keys(pattern: str) -> None:
+    client = redis.get_client()
+    for key in client.scan_iter(match=pattern):
+        client.delete(key)
@@ -0,0 +1,55 @@
+import pandas as pd
+
+from backend.profiling.approximate import ApproximateColumnProfile, update_profiles
+
+
+def _profile(chunks):
+    column = ApproximateColumnProfile("column")
+    for chunk in chunks:
+        column.update(pd.Series(chunk))
+    return column
+
+
+def test_round_trip_keeps_the_range_of_appended_rows():
+    stored = _profile([[3, 1, 2]]).to_properties()
+
+    column = ApproximateColumnProfile.from_properties("column", stored)
+    column.update(pd.Series([0, 10]))
+    properties = column.to_properties()
+
+    assert (properties["min"], properties["max"]) == (0, 10)
+    assert properties["row_count"] == 5
+
+
+def test_round_trip_of_mixed_types_stays_without_range():
+    stored = _profile([[3, 1, 2], ["a", "b", None]]).to_properties()
+    assert (stored["min"], stored["max"]) == ('', '')
+
+    column = ApproximateColumnProfile.from_properties("column", stored)
+    column.update(pd.Series([0, 10]))
+    properties = column.to_properties()
+
+    # The appended rows alone do not give the range of the whole column
+    assert (properties["min"], properties["max"]) == ('', '')
+    assert properties["row_count"] == 7
+    assert properties["null_values"] == 1
+
+
+def test_round_trip_of_profiles_stored_without_flag():
+    stored = _profile([[3, 1, 2], ["a", "b"]]).to_properties()
+    stored.pop("comparable")
+
+    column = ApproximateColumnProfile.from_properties("column", stored)
+    column.update(pd.Series([0, 10]))
+
+    assert not column.comparable
+
+
+def test_update_profiles_counts_nulls_per_column():
+    chunk = pd.DataFrame({"a": [1, None, 3], "b": ["x", "y", None]})
+    profiles = {name: ApproximateColumnProfile(name) for name in chunk.columns}
+    update_profiles(profiles, chunk)
+
+    assert (profiles["a"].null_count, profiles["a"].row_count) == (1, 2)
+    assert (profiles["b"].null_count, profiles["b"].row_count) == (1, 2)
+    assert profiles["b"].cardinality == 3
@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+
+from backend.profiling import ind_finder
+
+TABLES = {
+    "a.csv": pd.DataFrame({
+        "id": [1, 2, 3],
+        "name": ["x", "y", "z"],
+        "mixed": pd.Series([1, "y", 2.0], dtype=object),
+    }),
+    "b.csv": pd.DataFrame({
+        "ref": [1, 2, 2, 3, 4],
+        "label": ["x", "y", "z", "w", None],
+        "mixed": pd.Series([1, "y", 2, "z", 3.5], dtype=object),
+    }),
+    "c.csv": pd.DataFrame({
+        "small": [2, 3, None],
+        "names": ["y", "z", "z"],
+        "numbers": pd.Series([1.0, 2.0, None], dtype=object),
+    }),
+}
+
+
+@pytest.fixture(autouse=True)
+def tables(monkeypatch):
+    monkeypatch.setattr(ind_finder.io_tools, "get_df", lambda path: TABLES[path].copy())
+    monkeypatch.setattr(ind_finder, "STREAM_BLOCK_SIZE", 2)
+
+
+def _inds(cands):
+    return {(repr(frm), repr(to)) for frm, tos in cands.items() for to in tos}
+
+
+def test_batch_finds_the_same_inds_as_pairwise():
+    pairwise = _inds(ind_finder.get_inclusion_dependencies(set(TABLES)))
+    batch = _inds(ind_finder.get_inclusion_dependencies_batch(set(TABLES)))
+
+    assert batch == pairwise
+    assert ("a.csv/mixed", "b.csv/mixed") in batch
+    assert ("c.csv/numbers", "b.csv/mixed") in batch
+
+
+def test_batch_with_focus_only_finds_inds_of_that_table():
+    batch = _inds(ind_finder.get_inclusion_dependencies_batch(set(TABLES), focus="c.csv"))
+    pairwise = {(frm, to) for frm, to in _inds(ind_finder.get_inclusion_dependencies(set(TABLES)))
+                if "c.csv/" in frm or "c.csv/" in to}
+
+    assert batch == pairwise
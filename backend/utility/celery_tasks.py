@@ -2,20 +2,44 @@ import itertools
 import logging
 import os
 import logging
+import sys
 
+from contextlib import ExitStack
+from typing import Any, Dict, List, Optional, Tuple
+
+from celery import chain, chord, group
 from celery.app.task import Task
+from celery.signals import worker_init
+from celery.result import GroupResult
+from celery.utils import uuid
 from backend import celery
 from .. import search, profiling, discovery
-from ..profiling.valentine import match, process_match
-from ..profiling.ind_finder import find_inclusion_dependencies
+from ..profiling.valentine import match_tables
+from ..profiling.ind_finder import find_inclusion_dependencies, find_inclusion_dependencies_batch
 from ..discovery.queries import delete_spurious_connections
 from ..search import io_tools
 from ..search import redis_tools as db
+from .celery_utils import TABLE_LEASE_TTL, claim_tables, lease, pair_lease, release_table
+from . import local_engine
 
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.ERROR)
 
+# Number of table pairs that a single pairwise subtask processes
+PAIRWISE_CHUNK_SIZE = int(os.environ.get('PAIRWISE_CHUNK_SIZE', 16))
+# Maximum number of pairwise subtasks that may be queued at once, 0 means unbounded
+PAIRWISE_MAX_PARALLEL_CHUNKS = int(os.environ.get('PAIRWISE_MAX_PARALLEL_CHUNKS', 0))
+# Either 'pairwise' to fan out per pair of tables, or 'batch' to find the INDs of many tables in a single pass
+IND_ENGINE = os.environ.get('IND_ENGINE', 'pairwise')
+# Either 'exact' for exact profiles (within the memory limit), or 'approximate' to profile with sketches only
+PROFILING_MODE = os.environ.get('PROFILING_MODE', 'exact')
+# Number of rows per chunk when streaming a table during ingestion
+PROFILING_CHUNK_SIZE = int(os.environ.get('PROFILING_CHUNK_SIZE', 100000))
+# Either 'celery' to fan pairwise work out to the workers, or 'local' to run it over a process pool within the task
+EXECUTION_ENGINE = os.environ.get('EXECUTION_ENGINE', 'celery')
+# Worker pools whose tasks run in a non-daemonic process, which the local engine needs to start its own processes
+LOCAL_ENGINE_POOLS = ('solo', 'thread')
 
 
 # The default class to use for logging exceptions properly and not hang
@@ -27,79 +51,259 @@ class LoggingTask(Task):
         logger.error('Task %s failed to execute', task_id, **kwargs)
 
 
+@worker_init.connect
+def check_worker_pool(sender=None, **kwargs):
+    """
+    Refuses to start a worker that cannot run the local execution engine. The children of the prefork pool are
+    daemonic processes, which may not start the process pool and the writer of the local engine.
+    """
+    if EXECUTION_ENGINE != 'local':
+        return
+    pool_cls = getattr(sender, 'pool_cls', '')
+    pool = pool_cls if isinstance(pool_cls, str) else pool_cls.__module__
+    if not any(allowed in pool for allowed in LOCAL_ENGINE_POOLS):
+        # Exceptions of signal receivers are only logged by Celery, so the worker has to exit by itself
+        logger.critical(f'EXECUTION_ENGINE=local needs a worker started with --pool=solo or --pool=threads, '
+                        f'not {pool}')
+        sys.exit(1)
+
+
+def _dispatch_pairs(task: Task, pair_task: Task, pairs: List[Tuple[Any, ...]],
+                    chunk_size: int = PAIRWISE_CHUNK_SIZE) -> None:
+    """
+    Replaces the given orchestrating task with chunked pairwise subtasks that are spread over the worker pool.
+
+    The chunks are dispatched in waves of at most PAIRWISE_MAX_PARALLEL_CHUNKS, and each wave is registered as a
+    fan-out of the orchestrating task so that its status tree keeps covering the whole run.
+    With the local execution engine the pairs are processed over a local process pool instead,
+    and when the task is called directly as a function, they are processed serially.
+    """
+    if EXECUTION_ENGINE == 'local' and pair_task.name in LOCAL_PAIR_KINDS:
+        local_engine.run_pairs(LOCAL_PAIR_KINDS[pair_task.name], pairs)
+        return
+
+    if task.request.called_directly:
+        for pair in pairs:
+            pair_task(*pair)
+        return
+
+    if not pairs:
+        return
+
+    chunk_tasks = list(pair_task.chunks(pairs, chunk_size).group().tasks)
+    wave_size = PAIRWISE_MAX_PARALLEL_CHUNKS or len(chunk_tasks)
+    logging.info(f"Dispatching {len(pairs)} pairs of {pair_task.name} in {len(chunk_tasks)} chunks")
+
+    waves = []
+    wave_results = []
+    for start in range(0, len(chunk_tasks), wave_size):
+        wave = chunk_tasks[start:start + wave_size]
+        wave_result = GroupResult(uuid(), [chunk.freeze() for chunk in wave], app=celery)
+        wave_result.save()
+        wave_results.append(wave_result.as_tuple())
+        waves.append(chord(wave, join_pairwise_wave.si()))
+
+    db.save_celery_fan_out(task.request.id, wave_results)
+    raise task.replace(chain(*waves))
+
+
 @celery.task
-def ingest_all_new_tables():
+def join_pairwise_wave():
+    """
+    Barrier that completes once all chunks of a pairwise wave are done.
+    """
+
+
+@celery.task
+def filter_connections():
+    """
+    Deletes the spurious connections that remain after profiling.
+    """
+    return delete_spurious_connections()
+
+
+@celery.task(bind=True)
+def ingest_all_new_tables(self):
     paths = search.io_tools.get_tables()
     if not paths:
         logging.warning(
             "No tables to process, make sure there is data present on the data volume...")
     else:
-        to_process = []
-        for table_path in paths:
-            if not db.table_exists(table_path):
-                logging.info(f"Found new table to process: {table_path}")
-                to_process.append(table_path)
+        to_process, in_flight = claim_tables(paths, self.request.id)
+        for table_path, owner in in_flight.items():
+            logging.info(f"Table {table_path} is already being ingested by run {owner}, skipping")
 
         if to_process:
-            logging.info(f"Processing {len(to_process)} new tables")
-            for table_path in to_process:
-                add_table(table_path)
+            logging.info(f"Processing {len(to_process)} new or modified tables")
+            # Overlapping runs attach to this run through the id of the tables it claimed, so it has to be retrievable
+            db.save_celery_task(self.request.id, self.AsyncResult(self.request.id).as_tuple())
+            pairwise = []
             for table_path in to_process:
-                profile_valentine_star(table_path)
-                find_inds_star(table_path)
+                pairwise.append(profile_valentine_star.si(table_path))
+                pairwise.append(find_inds_star.si(table_path))
+            pairwise.append(filter_connections.si())
 
-            logging.info("Cleaning up...")
-            delete_spurious_connections()
+            header = group(*[add_table.si(table_path, self.request.id) for table_path in to_process])
+            raise self.replace(chord(header, chain(*pairwise)))
         else:
             logging.info("No new tables to process")
 
 
 @celery.task
-def add_table(table_path: str):
+def add_table(table_path: str, owner: Optional[str] = None):
     """
     Adds a table at the given table path to Daisy's databases.
+
+    A table that was ingested before is re-profiled in place, replacing its stale nodes and relations.
+    The claim of the ingestion run with the given owner id on the table is released once it is done, also when it
+    fails. Without an owner, the claim is left to expire.
+    """
+    try:
+        _add_table(table_path)
+    finally:
+        if owner is not None:
+            release_table(table_path, owner)
+
+
+def _add_table(table_path: str):
+    table = db.get_table(table_path)
+    stored = table.get("fingerprint") if table else None
+    fingerprint = search.io_tools.get_fingerprint(table_path, prefix_size=stored["size"] if stored else None)
+    offset = search.io_tools.get_appended_offset(table_path, stored, fingerprint) if stored else None
+    fingerprint.pop("prefix_hash", None)
+
+    if offset is None or not _append_to_table(table_path, table, fingerprint, offset):
+        _ingest_table(table_path, table is not None, fingerprint)
+    if table is not None:
+        # The cached matches of the previous content can never be replayed again
+        db.delete_valentine_matches(table_path)
+
+    logging.info(f"- Extracting schema features for matching {table_path}")
+    features = profiling.schema_features.get_table_features(db.get_table(table_path)["dtypes"])
+    db.save_schema_features(table_path, features)
+
+
+def _append_to_table(table_path: str, table: Dict[str, Any], fingerprint: Dict[str, Any], offset: int) -> bool:
+    """
+    Merges the rows that were appended to the table from the given byte offset into its stored profiles and
+    signatures, keeping its nodes. The relations of the table are removed, since they are found again afterwards.
+
+    Only profiles with stored sketches can be merged, which are those of the approximate mode. Returns False if the
+    table has to be profiled from scratch instead.
     """
+    if PROFILING_MODE != 'approximate':
+        return False
+    nodes = {node['name']: dict(node) for node in discovery.crud.get_table_nodes(table_path)}
+    signatures = db.get_signatures(table_path)
+    if signatures is None or set(nodes) != set(table['nodes']) \
+            or not all('hll_sketch' in node and 'quantile_sketch' in node for node in nodes.values()):
+        return False
+
+    logging.info(f"- Profiling the rows appended to table at {table_path}")
+    columns = {name: profiling.approximate.ApproximateColumnProfile.from_properties(name, node)
+               for name, node in nodes.items()}
+    minhashes = profiling.minhash.from_signatures(signatures)
+    try:
+        for chunk in search.io_tools.iter_df_chunks(table_path, PROFILING_CHUNK_SIZE, dialect=table['dialect'],
+                                                    dtypes=table['dtypes'], offset=offset):
+            profiling.minhash.update_column_minhashes(minhashes, chunk)
+            profiling.approximate.update_profiles(columns, chunk)
+    except (ValueError, KeyError) as e:
+        logging.warning(f"Could not profile the appended rows of table {table_path}, profiling it again: {e}")
+        return False
+
+    profiles = {name: column.to_properties() for name, column in columns.items()}
+    dtypes = {name: profile['data_type'] for name, profile in profiles.items()}
+    discovery.crud.delete_table_relations(table_path)
+    discovery.crud.update_table_nodes(table_path, profiles)
+    db.save_signatures(table_path, profiling.minhash.to_signatures(minhashes))
+    db.add_table(table['name'], table_path, len(profiles), table['nodes'], table['dialect'], dtypes, fingerprint)
+    return True
+
+
+def _ingest_table(table_path: str, exists: bool, fingerprint: Dict[str, Any]):
     table_name = table_path.split('/')[-1]
     asset_id = table_path.partition("/resources")[0]
-    logging.info(f"- Parsing table at {table_path} into DataFrame")
-    df = search.io_tools.get_df(table_path)
-    # Split the dataframe into a new dataframe for each column
-    logging.info(f"- Adding whole table metadata to neo4j for {table_path}")
-    nodes = {}
-    for col in df.columns:
-        node = discovery.crud.create_node(asset_id, table_name, table_path, col)
-        node_id = node[0]['id']
-        nodes[col] = node_id
+    if exists:
+        logging.info(f"- Removing stale nodes of previously ingested table at {table_path}")
+        discovery.crud.delete_table_nodes(table_path)
+    logging.info(f"- Detecting dialect of table at {table_path}")
+    dialect = search.io_tools.sniff_dialect(table_path)
+    logging.info(f"- Profiling table at {table_path} in chunks of {PROFILING_CHUNK_SIZE} rows")
+    profiles, dtypes, signatures = _profile_table_streaming(table_path, dialect)
 
-        discovery.crud.set_node_properties(
-            node_id, **profiling.pandas.get_profile_column(df[col]))
+    logging.info(f"- Adding whole table metadata to neo4j for {table_path}")
+    nodes = {node['name']: node['id'] for node in discovery.crud.create_nodes(asset_id, table_name, table_path, profiles)}
 
     discovery.crud.create_subsumption_relation(table_path)
 
     logging.info(f"- Adding ingestion record to db")
 
-    db.add_table(table_name, table_path, len(df.columns), nodes)
+    # The signatures are saved first, since they are loaded again once the stored fingerprint changes
+    db.save_signatures(table_path, signatures)
+    db.add_table(table_name, table_path, len(profiles), nodes, dialect, dtypes, fingerprint)
 
 
-@celery.task
-def profile_valentine_all():
+def _profile_table_streaming(table_path: str, dialect: Dict[str, str]):
+    """
+    Profiles the table at the given path without ever loading more than a single chunk.
+
+    Returns the profiles, the dtypes and the MinHash signatures per column.
+    """
+    minhashes = {}
+
+    def chunks():
+        empty = True
+        for chunk in search.io_tools.iter_df_chunks(table_path, PROFILING_CHUNK_SIZE, dialect=dialect):
+            empty = False
+            profiling.minhash.update_column_minhashes(minhashes, chunk)
+            yield chunk
+        if empty:
+            # Tables without rows still get a node per column
+            yield search.io_tools.get_df(table_path, rows=0, dialect=dialect)
+
+    columns = profiling.streaming.get_profiles_streaming(chunks(), approximate=PROFILING_MODE == 'approximate')
+    profiles = {name: column.to_properties() for name, column in columns.items()}
+    dtypes = {name: profile['data_type'] for name, profile in profiles.items()}
+    return profiles, dtypes, profiling.minhash.to_signatures(minhashes)
+
+
+@celery.task(bind=True)
+def profile_valentine_all(self):
     """
     Profiles all tables against each other.
     """
     all_tables = io_tools.get_tables()
-    for table_path_1, table_path_2 in itertools.combinations(all_tables, r=2):
-        profile_valentine_pair(table_path_1, table_path_2)
+    pairs = profiling.minhash.prune_pairs(list(itertools.combinations(all_tables, r=2)))
+    _dispatch_valentine_pairs(self, pairs)
 
 
-@celery.task
-def profile_valentine_star(table_path: str):
+@celery.task(bind=True)
+def profile_valentine_star(self, table_path: str):
     """
     Profiles all other tables against the table at the given path.
     """
     all_tables = io_tools.get_tables()
-    for other in all_tables:
-        if table_path != other:
-            profile_valentine_pair(table_path, other)
+    pairs = profiling.minhash.prune_pairs([(table_path, other) for other in all_tables if table_path != other])
+    _dispatch_valentine_pairs(self, pairs)
+
+
+def _dispatch_valentine_pairs(task: Task, pairs: List[Tuple[str, str]]) -> None:
+    """
+    Dispatches the pairs to match, grouped by their first table into batches that only read that table once.
+    The local execution engine still processes them pair by pair.
+    """
+    if EXECUTION_ENGINE == 'local':
+        _dispatch_pairs(task, profile_valentine_pair, pairs)
+        return
+
+    others_by_table: Dict[str, List[str]] = {}
+    for table_path, other in pairs:
+        others_by_table.setdefault(table_path, []).append(other)
+    batches = [(table_path, others[start:start + PAIRWISE_CHUNK_SIZE])
+               for table_path, others in others_by_table.items()
+               for start in range(0, len(others), PAIRWISE_CHUNK_SIZE)]
+    _dispatch_pairs(task, profile_valentine_batch, batches, chunk_size=1)
 
 
 @celery.task
@@ -109,28 +313,79 @@ def profile_valentine_pair(table_path_1: str, table_path_2: str):
     """
     logging.info(f'Valentining files: {table_path_1}, {table_path_2}')
     rows_to_use = int(os.environ['VALENTINE_ROWS_TO_USE'])
-    df1 = search.io_tools.get_df(table_path_1, rows=rows_to_use)
-    df2 = search.io_tools.get_df(table_path_2, rows=rows_to_use)
-    matches = match(df1, df2)
-    process_match(table_path_1, table_path_2, matches)
+    with pair_lease('valentine', table_path_1, table_path_2) as acquired:
+        if acquired:
+            match_tables(table_path_1, table_path_2, rows_to_use)
 
 
 @celery.task
 def find_inds_pair(table_path_1: str, table_path_2: str):
     logging.info(f'Finding INDs between: {table_path_1}, {table_path_2}')
-    find_inclusion_dependencies([table_path_1, table_path_2])
+    with pair_lease('inds', table_path_1, table_path_2) as acquired:
+        if acquired:
+            find_inclusion_dependencies([table_path_1, table_path_2])
 
 
 @celery.task
-def find_inds_star(table_path: str):
-    all_tables = io_tools.get_tables()
-    for other in all_tables:
-        if table_path != other:
-            find_inds_pair(table_path, other)
+def profile_valentine_batch(table_path: str, other_paths: List[str]):
+    """
+    Profiles the other tables against the table at the given path, reading the first rows of that table only once and
+    skipping the pairs that are already in progress.
+    """
+    rows_to_use = int(os.environ['VALENTINE_ROWS_TO_USE'])
+    df = None
+    for other in other_paths:
+        with pair_lease('valentine', table_path, other) as acquired:
+            if not acquired:
+                continue
+            logging.info(f'Valentining files: {table_path}, {other}')
+            if df is None and profiling.valentine.MATCHER == 'coma':
+                df = io_tools.get_df(table_path, rows=rows_to_use)
+            match_tables(table_path, other, rows_to_use, df)
+
+
+# The kind of pairwise work that the local execution engine runs for each pairwise task
+LOCAL_PAIR_KINDS = {
+    profile_valentine_pair.name: local_engine.VALENTINE,
+    find_inds_pair.name: local_engine.INDS,
+}
 
 
 @celery.task
-def find_inds_all():
+def find_inds_batch(table_path: str, other_paths: List[str]):
+    """
+    Finds the INDs between the table at the given path and the other tables in a single merge, skipping the pairs that
+    are already in progress.
+    """
+    with ExitStack() as leases:
+        leased = [other for other in other_paths if leases.enter_context(pair_lease('inds', table_path, other))]
+        if leased:
+            logging.info(f'Finding INDs between {table_path} and {len(leased)} other tables')
+            find_inclusion_dependencies_batch({table_path, *leased}, focus=table_path)
+
+
+@celery.task(bind=True)
+def find_inds_star(self, table_path: str):
+    all_tables = io_tools.get_tables()
+    others = [other for other in all_tables if table_path != other]
+    if IND_ENGINE == 'batch':
+        # Every subtask merges the table with a chunk of the other tables
+        batches = [(table_path, others[start:start + PAIRWISE_CHUNK_SIZE])
+                   for start in range(0, len(others), PAIRWISE_CHUNK_SIZE)]
+        _dispatch_pairs(self, find_inds_batch, batches, chunk_size=1)
+    else:
+        _dispatch_pairs(self, find_inds_pair, [(table_path, other) for other in others])
+
+
+@celery.task(bind=True)
+def find_inds_all(self):
     all_tables = io_tools.get_tables()
-    for table_path_1, table_path_2 in itertools.combinations(all_tables, r=2):
-        find_inds_pair(table_path_1, table_path_2)
+    if IND_ENGINE == 'batch':
+        with lease('inds:all', TABLE_LEASE_TTL) as acquired:
+            if not acquired:
+                logging.info('Skipping the INDs between all tables, they are already being found')
+                return
+            logging.info(f'Finding INDs between all {len(all_tables)} tables')
+            find_inclusion_dependencies_batch(set(all_tables))
+    else:
+        _dispatch_pairs(self, find_inds_pair, list(itertools.combinations(all_tables, r=2)))
@@ -1,8 +1,19 @@
-from typing import Dict, Union, Any
+import logging
+import os
 
-from celery.result import AsyncResult, GroupResult
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple, Union, Any
+
+from celery.result import AsyncResult, GroupResult, result_from_tuple
+from celery.utils import uuid
 
 from backend import celery as celery_app
+from backend.search import io_tools, redis_tools
+
+# Seconds after which the claim of an ingestion run on a table expires, in case the run died without releasing it
+TABLE_LEASE_TTL = int(os.environ.get('TABLE_LEASE_TTL', 3600))
+# Seconds after which the claim of a pairwise task on a table pair expires
+PAIR_LEASE_TTL = int(os.environ.get('PAIR_LEASE_TTL', 600))
 
 
 # Based on solution(s)/comments/source in: 
@@ -39,5 +50,78 @@ def generate_status_tree(result: Union[AsyncResult, GroupResult]) -> Dict[
     result_dict["id"] = result_id
     result_dict["parent"] = generate_status_tree(result.parent) if result.parent else None
     result_dict["children"] = [generate_status_tree(child) for child in result.children] if result.children else []
+    # Orchestrating tasks replace themselves with pairwise subtasks, which are not tracked as regular children
+    result_dict["children"] += [generate_status_tree(result_from_tuple(fan_out, celery_app))
+                                for fan_out in redis_tools.get_celery_fan_out(result_id)]
 
     return result_dict
+
+
+def _table_lease(table_path: str) -> str:
+    return f"ingest:{table_path}"
+
+
+def claim_tables(table_paths: List[str], owner: str, force: bool = False) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Claims the given tables that need to be ingested for the ingestion run with the given owner id, or all of them
+    that are not in flight when the ingestion is forced.
+
+    Returns the claimed tables, and the tables that are already in flight together with the id of the run
+    ingesting them. Whether a table needs ingestion is checked while holding its lease, so a table that another
+    run just finished is not ingested again. The claims are released by the add_table task, or right away if
+    claiming fails.
+    """
+    claimed = []
+    in_flight = {}
+    try:
+        for table_path in table_paths:
+            lease = _table_lease(table_path)
+            if not redis_tools.acquire_lease(lease, owner, TABLE_LEASE_TTL):
+                in_flight[table_path] = redis_tools.get_lease_owner(lease)
+                continue
+            # Claimed while checking, so the lease is also released when the check fails
+            claimed.append(table_path)
+            if not force and not io_tools.needs_ingestion(table_path):
+                claimed.pop()
+                redis_tools.release_lease(lease, owner)
+    except Exception:
+        for table_path in claimed:
+            release_table(table_path, owner)
+        raise
+    return claimed, in_flight
+
+
+def release_table(table_path: str, owner: str) -> None:
+    """
+    Releases the claim of the ingestion run with the given owner id on the table, unless another run holds it by now.
+    """
+    redis_tools.release_lease(_table_lease(table_path), owner)
+
+
+@contextmanager
+def lease(name: str, ttl: int = PAIR_LEASE_TTL) -> Iterator[bool]:
+    """
+    Holds the lease with the given name for as long as the context lasts, yields whether it was acquired.
+    """
+    owner = uuid()
+    acquired = redis_tools.acquire_lease(name, owner, ttl)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            redis_tools.release_lease(name, owner)
+
+
+@contextmanager
+def pair_lease(kind: str, table_path_1: str, table_path_2: str) -> Iterator[bool]:
+    """
+    Holds the lease of the given kind of pairwise task on the two tables, yields whether it was acquired.
+
+    A pair that is already being processed by another task should be skipped, since that task adds the same relations.
+    """
+    # The same pair is leased regardless of the order of its tables
+    table_path_1, table_path_2 = sorted((table_path_1, table_path_2))
+    with lease(f"{kind}:{table_path_1}:{table_path_2}") as acquired:
+        if not acquired:
+            logging.info(f"Skipping {kind} of {table_path_1}, {table_path_2}, it is already in progress")
+        yield acquired
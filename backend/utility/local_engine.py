@@ -0,0 +1,112 @@
+"""
+Runs pairwise profiling over a local process pool instead of Celery workers.
+
+The pool processes only compute matches and INDs. Their results are funnelled to a single writer process that adds all
+relations to Neo4j, so the graph is written by one connection in large batches. Redis and Neo4j are still needed,
+since those hold the ingested tables, but the broker and the Celery workers are not.
+
+Run a backfill of all ingested tables inside the backend container with: python -m backend.utility.local_engine
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import combinations
+from typing import Any, List, Optional, Tuple
+
+from backend.discovery.relation_sink import RelationSink
+from backend.profiling import minhash
+from backend.profiling.ind_finder import _add_inclusion_dependencies, get_inclusion_dependencies
+from backend.profiling.valentine import get_matches, process_match
+from backend.search import io_tools
+from backend.utility.celery_utils import pair_lease
+
+# Number of pool processes, 0 means one per CPU
+LOCAL_MAX_WORKERS = int(os.environ.get('LOCAL_MAX_WORKERS', 0))
+
+# Kinds of pairwise work
+VALENTINE = "valentine"
+INDS = "inds"
+KINDS = (VALENTINE, INDS)
+
+# Processes are spawned rather than forked, so they never share the database connections of the parent
+_context = multiprocessing.get_context("spawn")
+
+
+def _compute_pair(kind: str, table_path_1: str, table_path_2: str) -> Optional[Any]:
+    with pair_lease(kind, table_path_1, table_path_2) as acquired:
+        if not acquired:
+            return None
+        if kind == VALENTINE:
+            return get_matches(table_path_1, table_path_2, int(os.environ['VALENTINE_ROWS_TO_USE']))
+        return get_inclusion_dependencies({table_path_1, table_path_2})
+
+
+def _write_results(results: multiprocessing.Queue) -> None:
+    """
+    Adds the relations of the pair results on the queue to Neo4j until it receives None.
+    """
+    with RelationSink() as sink:
+        for kind, table_path_1, table_path_2, result in iter(results.get, None):
+            if kind == VALENTINE:
+                process_match(table_path_1, table_path_2, result, sink=sink)
+            else:
+                _add_inclusion_dependencies(result, sink=sink)
+
+
+def _in_daemon_process() -> bool:
+    # The children of the prefork pool of Celery are daemonic processes of billiard, its fork of multiprocessing
+    if multiprocessing.current_process().daemon:
+        return True
+    try:
+        import billiard
+    except ImportError:
+        return False
+    return bool(billiard.current_process().daemon)
+
+
+def run_pairs(kind: str, pairs: List[Tuple[str, str]], max_workers: int = LOCAL_MAX_WORKERS) -> None:
+    """
+    Processes the given pairs of tables with the given kind of pairwise work over a local process pool.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind of pairwise work: {kind}")
+    if not pairs:
+        return
+    if _in_daemon_process():
+        raise RuntimeError("The local engine cannot start processes from a daemonic process, run the Celery worker "
+                           "with --pool=solo or --pool=threads")
+
+    results = _context.Queue()
+    writer = _context.Process(target=_write_results, args=(results,), name="relation-writer")
+    writer.start()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers or None, mp_context=_context) as pool:
+            futures = {pool.submit(_compute_pair, kind, *pair): pair for pair in pairs}
+            for future in as_completed(futures):
+                result = future.result()
+                if result is not None:
+                    results.put((kind, *futures[future], result))
+    finally:
+        results.put(None)
+        writer.join()
+
+    if writer.exitcode != 0:
+        raise RuntimeError(f"The relation writer failed with exit code {writer.exitcode}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    tables = io_tools.get_tables()
+    for pairwise_kind in sys.argv[1:] or KINDS:
+        all_pairs = list(combinations(tables, r=2))
+        if pairwise_kind == VALENTINE:
+            all_pairs = minhash.prune_pairs(all_pairs)
+        start = time.perf_counter()
+        run_pairs(pairwise_kind, all_pairs)
+        elapsed = time.perf_counter() - start
+        print(f"{pairwise_kind}: {len(all_pairs)} pairs in {elapsed:.2f}s "
+              f"({len(all_pairs) / max(elapsed, 1e-9):.1f} pairs/s)")
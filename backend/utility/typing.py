@@ -1,5 +1,5 @@
 from typing_extensions import TypedDict
-from typing import Dict
+from typing import Any, Dict
 
 
 class Table(TypedDict):
@@ -10,3 +10,6 @@ class Table(TypedDict):
     name: str
     column_count: int
     nodes: Dict[str, str]
+    dialect: Dict[str, str]
+    dtypes: Dict[str, str]
+    fingerprint: Dict[str, Any]